@@ -0,0 +1,235 @@
+'''
+Benchmark of the genin2 pipeline on synthetic samples. Each input size is measured in a separate process, so that
+the peak memory usage of each run is reported independently. The results can be saved as JSON and compared with
+those of another version.
+
+Usage:
+    python benchmarks/bench.py --sizes 10,100,1000 -o results.json
+    python benchmarks/bench.py --sizes 10,100,1000 --compare results.json
+
+The stages are timed with internal functions that older versions don't have: on those, and with `--cli`, only the
+command line tool is timed as a whole.
+'''
+import click, datetime, importlib.util, json, os, platform, subprocess, sys, tempfile, time
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional
+
+sys.path.insert(0, str(Path(__file__).parent))
+from synthetic import DEFAULT_PARAMS, MutationParams, generate_samples, write_fasta
+
+
+STAGES = ['load_models', 'read_fasta', 'pairwise_alignment', 'cut_alignment', 'alignment', 'encode_sequence', 'predict', 'di_discriminator', 'end_to_end', 'cli']
+
+
+def peak_rss_mb(children: bool = False) -> Optional[float]:
+    try:
+        import resource
+    except ImportError:
+        return None # Not available on Windows
+    rss = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 / 1024 if sys.platform == 'darwin' else rss / 1024 # Bytes on macOS, KiB elsewhere
+
+
+def has_stages() -> bool:
+    # Whether the installed version has the modules with which the stages are timed
+    return importlib.util.find_spec('genin2.aligner') is not None and importlib.util.find_spec('genin2.predictor') is not None
+
+
+def measure(n: int, seed: int, params: MutationParams, legacy_alignment: bool) -> dict:
+    '''
+    Run each stage of the pipeline on `n` synthetic samples and time it.
+
+    The stages are run one after the other on the output of the previous one, as the pipeline does:
+    reading, alignment, encoding and classification with the segment models. The DI discriminator is run on all the
+    samples, regardless of their genotype, to measure its cost. Finally, the whole prediction is run end to end with
+    `Genin2Predictor.predict_many()`.
+    '''
+    import numpy as np
+    from genin2.aligner import new_aligner, project_to_reference
+    from genin2.genin2_core import preload_samples
+    from genin2.predictor import Genin2Predictor
+    from genin2.utils import alignment_refs, cut_alignment, encode_sequence
+
+    timings, counts = Counter(), Counter()
+
+    @contextmanager
+    def stage(name: str, count: int = 1):
+        start = time.perf_counter()
+        yield
+        timings[name] += time.perf_counter() - start
+        counts[name] += count
+
+    with stage('load_models'):
+        predictor = Genin2Predictor()
+        predictor.di_discr.dd_models
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fasta_path = Path(tmp_dir).joinpath('samples.fa')
+        with open(fasta_path, 'w') as f:
+            write_fasta(generate_samples(n, seed, params), f)
+        with stage('read_fasta', n), open(fasta_path) as f:
+            samples = list(preload_samples(f).items())
+
+    segments = [
+        (idx, seg_name, seq) for idx, (_, sample) in enumerate(samples) for seg_name, seq in sample.items()
+        if (len(seq) - seq.count('N')) / len(alignment_refs[seg_name]) >= predictor.min_seq_cov
+    ]
+
+    if legacy_alignment:
+        aligner = new_aligner()
+        for _, seg_name, seq in segments:
+            with stage('pairwise_alignment'):
+                ref_al, q_al = aligner.align(alignment_refs[seg_name], seq)[0]
+            with stage('cut_alignment'):
+                cut_alignment(ref_al, q_al)
+
+    aligned = []
+    for idx, seg_name, seq in segments:
+        with stage('alignment'):
+            aligned.append((idx, seg_name, project_to_reference(seg_name, seq)))
+
+    encoded_samples = [{} for _ in samples]
+    rows: dict[str, list] = {seg_name: [] for seg_name in alignment_refs.keys()}
+    for idx, seg_name, aligned_seq in aligned:
+        with stage('encode_sequence'):
+            encoded_samples[idx][seg_name] = encode_sequence(aligned_seq)
+        rows[seg_name].append(encoded_samples[idx][seg_name])
+
+    for seg_name, seg_rows in rows.items():
+        if seg_rows:
+            matrix = np.stack(seg_rows)
+            with stage('predict', len(seg_rows)):
+                predictor.classify_segments(seg_name, matrix)
+
+    with stage('di_discriminator', n):
+        predictor.di_discr.predict_encoded(encoded_samples)
+
+    with stage('end_to_end', n):
+        list(predictor.predict_many(samples))
+
+    return {
+        'samples': n,
+        'sequences': sum(len(sample) for _, sample in samples),
+        'mode': 'stages',
+        'samples_per_sec': n / (timings['read_fasta'] + timings['end_to_end']),
+        'peak_rss_mb': peak_rss_mb(),
+        'stages': {
+            name: {'seconds': timings[name], 'count': counts[name]}
+            for name in STAGES if name in timings
+        },
+    }
+
+
+def measure_cli(n: int, seed: int, params: MutationParams) -> dict:
+    '''
+    Time the command line tool on `n` synthetic samples, from start-up (including loading the models) to the writing of
+    the output. Only the interface common to all versions is used, so that any version can be compared with another.
+    '''
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fasta_path, out_path = Path(tmp_dir).joinpath('samples.fa'), Path(tmp_dir).joinpath('out.tsv')
+        samples = list(generate_samples(n, seed, params))
+        with open(fasta_path, 'w') as f:
+            write_fasta(samples, f)
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, '-c', 'from genin2.cli import start_cli; start_cli()', str(fasta_path), '-o', str(out_path)],
+            check=True, stdout=subprocess.DEVNULL,
+        )
+        seconds = time.perf_counter() - start
+
+    return {
+        'samples': n,
+        'sequences': sum(len(sample) for _, sample in samples),
+        'mode': 'cli',
+        'samples_per_sec': n / seconds,
+        'peak_rss_mb': peak_rss_mb(children=True),
+        'stages': {'cli': {'seconds': seconds, 'count': n}},
+    }
+
+
+def environment() -> dict:
+    import numpy, sklearn, Bio
+    from genin2.genin2_core import __version__
+    return {
+        'genin2': __version__,
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'sklearn': sklearn.__version__,
+        'biopython': Bio.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+    }
+
+
+def print_results(results: list, baseline: Optional[dict]) -> None:
+    if baseline is not None:
+        print(f"Speed-ups relative to genin2 {baseline['environment']['genin2']} ({baseline['environment']['date']}), > 1 is faster")
+    base_by_size = {r['samples']: r for r in baseline['results']} if baseline is not None else {}
+    for res in results:
+        base = base_by_size.get(res['samples'])
+        if base is not None and base.get('mode', 'stages') != res['mode']:
+            base = None # Throughputs measured in different ways are not comparable
+        rss = f"{res['peak_rss_mb']:.0f} MB" if res['peak_rss_mb'] is not None else 'n/a'
+        line = f"{res['samples']:>7d} samples: {res['samples_per_sec']:9.1f} samples/s, peak RSS {rss}"
+        if base is not None:
+            line += f"  [{res['samples_per_sec'] / base['samples_per_sec']:.2f}x]"
+        print(line)
+
+        for name, stage in res['stages'].items():
+            line = f"    {name:20s} {stage['seconds']:9.3f} s"
+            if name in (base or {}).get('stages', {}) and base['stages'][name]['seconds'] > 0:
+                line += f"  [{base['stages'][name]['seconds'] / max(stage['seconds'], 1e-9):.2f}x]"
+            print(line)
+
+
+@click.command()
+@click.option('--sizes', default='10,100,1000', show_default=True, help='Comma-separated numbers of samples to benchmark')
+@click.option('--seed', type=int, default=1, show_default=True, help='Seed of the synthetic sample generator')
+@click.option('--repeat', type=click.IntRange(min=1), default=1, show_default=True, help='Run each size multiple times and keep the fastest run')
+@click.option('--legacy-alignment', is_flag=True, help='Also time the global alignment (pairwise_alignment + cut_alignment) used before the anchored aligner')
+@click.option('--cli', is_flag=True, help='Only time the command line tool as a whole, as on versions that cannot be timed by stage')
+@click.option('--mutation-rate', type=click.FloatRange(0, 1), default=DEFAULT_PARAMS.mutation_rate, show_default=True)
+@click.option('--indel-rate', type=click.FloatRange(0, 1), default=DEFAULT_PARAMS.indel_rate, show_default=True)
+@click.option('--n-run-prob', type=click.FloatRange(0, 1), default=DEFAULT_PARAMS.n_run_prob, show_default=True)
+@click.option('--truncate-prob', type=click.FloatRange(0, 1), default=DEFAULT_PARAMS.truncate_prob, show_default=True)
+@click.option('--subset-prob', type=click.FloatRange(0, 1), default=DEFAULT_PARAMS.subset_prob, show_default=True)
+@click.option('-o', '--output-file', type=click.Path(dir_okay=False), help='Save the results to this JSON file')
+@click.option('--compare', type=click.File('r'), help='JSON results of a previous run to compare with')
+@click.option('--child', type=int, hidden=True, help='Measure a single size and print the results as JSON (used internally)')
+def main(sizes, seed, repeat, legacy_alignment, cli, output_file, compare, child, **kwargs):
+    params = MutationParams(**kwargs)
+    if child is not None:
+        result = measure_cli(child, seed, params) if cli else measure(child, seed, params, legacy_alignment)
+        print(json.dumps(result))
+        return
+
+    if not cli and not has_stages():
+        click.echo("This version of genin2 cannot be timed by stage, only the command line tool is timed", err=True)
+        cli = True
+    args = [f'--seed={seed}'] + [f'--{k.replace("_", "-")}={v}' for k, v in kwargs.items()]
+    if legacy_alignment:
+        args.append('--legacy-alignment')
+    if cli:
+        args.append('--cli')
+
+    results = []
+    for n in (int(size) for size in sizes.split(',')):
+        runs = []
+        for _ in range(repeat):
+            proc = subprocess.run([sys.executable, __file__, f'--child={n}', *args], stdout=subprocess.PIPE, text=True)
+            if proc.returncode != 0:
+                raise click.ClickException(f"The benchmark with {n} samples failed")
+            runs.append(json.loads(proc.stdout))
+        results.append(max(runs, key=lambda r: r['samples_per_sec']))
+
+    report = {'environment': environment(), 'params': params._asdict(), 'seed': seed, 'results': results}
+    print_results(results, json.load(compare) if compare is not None else None)
+    if output_file is not None:
+        Path(output_file).write_text(json.dumps(report, indent=2) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+'''
+Generator of synthetic samples for benchmarking, derived from the alignment references of each segment.
+
+Usage:
+    python benchmarks/synthetic.py -n 1000 -o samples.fa
+'''
+import click, random
+from typing import Iterator, NamedTuple, Tuple, TextIO
+from genin2.utils import alignment_refs
+
+
+MutationParams = NamedTuple('MutationParams', [
+    ('mutation_rate', float), # Probability of a substitution at each position
+    ('indel_rate', float), # Probability of an insertion or deletion (1-6 nt) at each position
+    ('n_run_prob', float), # Probability that a segment contains a run of 10-200 Ns
+    ('truncate_prob', float), # Probability that a segment is truncated by up to 300 nt at each end
+    ('subset_prob', float), # Probability that a sample only contains a random subset of its segments
+])
+
+DEFAULT_PARAMS = MutationParams(mutation_rate=0.01, indel_rate=0.0005, n_run_prob=0.05, truncate_prob=0.1, subset_prob=0.2)
+
+
+def mutate(ref_seq: str, rnd: random.Random, params: MutationParams) -> str:
+    seq, pos = [], 0
+    while pos < len(ref_seq):
+        r = rnd.random()
+        if r < params.indel_rate / 2:
+            pos += rnd.randint(1, 6) # Deletion
+            continue
+        if r < params.indel_rate:
+            seq.extend(rnd.choices('ACGT', k=rnd.randint(1, 6))) # Insertion
+        nt = ref_seq[pos]
+        seq.append(rnd.choice('ACGT'.replace(nt, '')) if rnd.random() < params.mutation_rate else nt)
+        pos += 1
+
+    if rnd.random() < params.n_run_prob:
+        start, length = rnd.randrange(len(seq)), rnd.randint(10, 200)
+        seq[start:start + length] = 'N' * min(length, len(seq) - start)
+    if rnd.random() < params.truncate_prob:
+        seq = seq[rnd.randint(0, 300):len(seq) - rnd.randint(0, 300)]
+    return ''.join(seq)
+
+
+def generate_samples(n: int, seed: int = 1, params: MutationParams = DEFAULT_PARAMS, prefix: str = 'sample') -> Iterator[Tuple[str, dict[str, str]]]:
+    '''
+    Generate synthetic samples by mutating the alignment references.
+
+    Args:
+        n (int): The number of samples
+        seed (int): The seed of the random generator. The same seed always generates the same samples.
+        params (MutationParams): The frequencies of the mutations
+        prefix (str): The prefix of the sample names, which are followed by the sample index
+
+    Yields:
+        Tuple[str, dict[str, str]]: The name of each sample and the sequence of each of its segments
+    '''
+    rnd = random.Random(seed)
+    for i in range(n):
+        seg_names = list(alignment_refs.keys())
+        if rnd.random() < params.subset_prob:
+            seg_names = sorted(rnd.sample(seg_names, rnd.randint(1, len(seg_names) - 1)), key=seg_names.index)
+        yield f'{prefix}{i}', {seg_name: mutate(alignment_refs[seg_name], rnd, params) for seg_name in seg_names}
+
+
+def write_fasta(samples: Iterator[Tuple[str, dict[str, str]]], file: TextIO, line_len: int = 70) -> None:
+    for sample_name, sample in samples:
+        for seg_name, seq in sample.items():
+            file.write(f'>{sample_name}_{seg_name}\n')
+            for start in range(0, len(seq), line_len):
+                file.write(seq[start:start + line_len] + '\n')
+
+
+@click.command()
+@click.option('-n', '--samples', 'n', type=click.IntRange(min=1), default=100, show_default=True, help='Number of samples')
+@click.option('--seed', type=int, default=1, show_default=True, help='Seed of the random generator')
+@click.option('--mutation-rate', type=click.FloatRange(0, 1), default=DEFAULT_PARAMS.mutation_rate, show_default=True, help='Probability of a substitution at each position')
+@click.option('--indel-rate', type=click.FloatRange(0, 1), default=DEFAULT_PARAMS.indel_rate, show_default=True, help='Probability of a short insertion or deletion at each position')
+@click.option('--n-run-prob', type=click.FloatRange(0, 1), default=DEFAULT_PARAMS.n_run_prob, show_default=True, help='Probability that a segment contains a run of Ns')
+@click.option('--truncate-prob', type=click.FloatRange(0, 1), default=DEFAULT_PARAMS.truncate_prob, show_default=True, help='Probability that a segment is truncated')
+@click.option('--subset-prob', type=click.FloatRange(0, 1), default=DEFAULT_PARAMS.subset_prob, show_default=True, help='Probability that a sample lacks some segments')
+@click.option('-o', '--output-file', type=click.File('w'), default='-', help='Output FASTA')
+def main(n, seed, output_file, **kwargs):
+    write_fasta(generate_samples(n, seed, MutationParams(**kwargs)), output_file)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,293 @@
+from bisect import bisect_left
+from collections import Counter
+from typing import Any, List, Tuple, TYPE_CHECKING
+from genin2.utils import alignment_refs
+import numpy as np
+
+if TYPE_CHECKING:
+    from Bio.Align import PairwiseAligner
+
+
+SEED_LEN = 12 # Length of the k-mers used to find seeds shared by the query and the reference
+WINDOW_HALF_LEN = 32 # Half the length of the ungapped window that must surround each anchor
+MAX_WINDOW_MISMATCHES = 3 # Maximum number of mismatches accepted in the window of an anchor
+MAX_SHIFT = 4 # Diagonal offsets against which the window of an anchor is compared
+MIN_SHIFT_MARGIN = 12 # Minimum difference in matches between the window of an anchor and any shifted window
+MIN_ANCHOR_DIST = 64 # Minimum distance between consecutive anchors
+MIN_END_DIST = 150 # Minimum distance between an anchor and a truncated end of the query
+MAX_ANCHOR_INDEL = 64 # Maximum difference between the diagonals of the anchors, beyond which no anchors are used
+# With the scores of `new_aligner()`, an ungapped alignment of two sequences of length n with m mismatches scores
+# n - 2m, while any gapped alignment of them leaves at least one nucleotide of each unpaired and opens two gaps, scoring
+# at most n - 9: up to this many mismatches, the ungapped alignment is the only optimal one
+MAX_UNGAPPED_MISMATCHES = 4
+
+_stats = Counter() # Number of alignments and of ungapped fast path hits, see `pop_stats()`
+
+
+def new_aligner() -> 'PairwiseAligner':
+    from Bio.Align import PairwiseAligner # Imported lazily, as it is slow to import and not needed by every invocation
+    aligner = PairwiseAligner()
+    aligner.match_score = 1
+    aligner.mismatch_score = -1
+    aligner.open_gap_score = -4
+    aligner.extend_gap_score = -1
+    return aligner
+
+
+class ReferenceAligner:
+    '''
+    Aligns query sequences against a fixed reference and projects them onto the reference coordinates, i.e. removes
+    the insertions with respect to the reference and fills the deletions with gaps.
+
+    Instead of running a global alignment over the whole sequences, which has a quadratic cost, the query is split at
+    a few anchors: positions where the query is unambiguously collinear with the reference (an ungapped window of
+    `2 * WINDOW_HALF_LEN` nucleotides with at most `MAX_WINDOW_MISMATCHES` mismatches, which matches much worse on the
+    neighbouring diagonals). Only the regions between consecutive anchors are globally aligned, with the same scoring
+    parameters, so that near-identical sequences are aligned in close to linear time.
+
+    Anchors are chosen conservatively so that the optimal global alignment is expected to pass through them, and the
+    result to be the same as the one of a global alignment of the whole sequences. This is not guaranteed, but it is
+    checked on the regression corpus of `tests/test_aligner.py`. The anchors are not placed close to truncated ends
+    of the query, where the end gap could otherwise be moved inside the sequence at no cost, nor in windows of the
+    reference that also occur elsewhere in the query (e.g. in duplications). Queries with long insertions or deletions
+    (anchors on diagonals more than `MAX_ANCHOR_INDEL` apart) are globally aligned as a whole.
+
+    Queries (and regions between anchors) that are as long as the reference and differ from it by at most
+    `MAX_UNGAPPED_MISMATCHES` substitutions are not aligned at all, as their optimal alignment is the ungapped one.
+    '''
+
+    def __init__(self, ref_seq: str):
+        self.ref_seq = ref_seq
+        self.aligner = new_aligner()
+
+        self.kmer_index = {kmer: pos[0] for kmer, pos in kmer_positions(ref_seq).items() if len(pos) == 1}
+
+    def project(self, seq: str) -> str:
+        '''
+        Align a sequence to the reference and project it onto the reference coordinates.
+
+        Args:
+            seq (str): The query sequence
+
+        Returns:
+            str: The projected sequence, as long as the reference
+        '''
+        _stats['alignments'] += 1
+        if is_ungapped(self.ref_seq, seq):
+            _stats['ungapped_alignments'] += 1
+            return seq
+
+        cuts = [(0, 0)] + self.find_anchors(seq) + [(len(seq), len(self.ref_seq))]
+        return ''.join(
+            self._align_region(self.ref_seq[r_start:r_end], seq[q_start:q_end])
+            for (q_start, r_start), (q_end, r_end) in zip(cuts, cuts[1:])
+        )
+
+    def find_anchors(self, seq: str) -> List[Tuple[int, int]]:
+        '''
+        Find the positions at which the alignment of a sequence can be split.
+
+        Args:
+            seq (str): The query sequence
+
+        Returns:
+            List[Tuple[int, int]]: The (query position, reference position) of each anchor, in increasing order
+        '''
+        chain = self.seed_chain(seq)
+        ref_seq, half = self.ref_seq, WINDOW_HALF_LEN
+        anchors, query_kmers = [], None
+
+        for j, (q_pos, r_pos) in enumerate(chain):
+            q_mid, diag = q_pos + SEED_LEN // 2, r_pos - q_pos
+            if anchors and q_mid - anchors[-1][0] < MIN_ANCHOR_DIST:
+                continue
+            if q_mid - half < 0 or q_mid + half > len(seq) or q_mid + diag - half < 0 or q_mid + diag + half > len(ref_seq):
+                continue
+
+            # All seeds around the anchor must be on the same diagonal
+            k = j
+            while k > 0 and chain[k - 1][0] >= q_mid - half - SEED_LEN and chain[k - 1][1] - chain[k - 1][0] == diag:
+                k -= 1
+            if k > 0 and chain[k - 1][0] >= q_mid - half - SEED_LEN:
+                continue
+            k = j
+            while k < len(chain) - 1 and chain[k + 1][0] <= q_mid + half and chain[k + 1][1] - chain[k + 1][0] == diag:
+                k += 1
+            if k < len(chain) - 1 and chain[k + 1][0] <= q_mid + half:
+                continue
+
+            window = seq[q_mid - half:q_mid + half]
+            matches = count_matches(window, ref_seq, q_mid + diag - half)
+            if 2 * half - matches > MAX_WINDOW_MISMATCHES:
+                continue
+            if any(matches - count_matches(window, ref_seq, q_mid + diag - half + shift) < MIN_SHIFT_MARGIN
+                   for shift in range(-MAX_SHIFT, MAX_SHIFT + 1) if shift != 0):
+                continue
+
+            # The reference around the anchor must not be found elsewhere in the query (e.g. in a duplication), where
+            # the optimal alignment could place it instead
+            if query_kmers is None:
+                query_kmers = kmer_positions(seq)
+            if is_repeated(ref_seq[q_mid + diag - half:q_mid + diag + half], q_mid - half, query_kmers):
+                continue
+
+            anchors.append((q_mid, q_mid + diag))
+
+        if anchors and anchors[0][0] != anchors[0][1]:
+            anchors = [a for a in anchors if a[0] >= MIN_END_DIST]
+        if anchors and len(ref_seq) - anchors[-1][1] != len(seq) - anchors[-1][0]:
+            anchors = [a for a in anchors if len(seq) - a[0] >= MIN_END_DIST]
+        # Across a long insertion or deletion, the optimal alignment can spread many mismatches and short gaps over the
+        # neighbouring regions rather than open a single long gap, and not pass through the anchors on either side
+        diags = [r_pos - q_pos for q_pos, r_pos in anchors]
+        if diags and max(diags) - min(diags) > MAX_ANCHOR_INDEL:
+            return []
+        return anchors
+
+    def seed_chain(self, seq: str) -> List[Tuple[int, int]]:
+        '''
+        Find the k-mers that occur exactly once in both the sequence and the reference, and return the longest chain
+        of them that is collinear in the two sequences.
+
+        Args:
+            seq (str): The query sequence
+
+        Returns:
+            List[Tuple[int, int]]: The (query position, reference position) of each seed, in increasing order
+        '''
+        seeds, kmer_counts = [], {}
+        for i in range(len(seq) - SEED_LEN + 1):
+            kmer = seq[i:i + SEED_LEN]
+            if (r_pos := self.kmer_index.get(kmer)) is not None:
+                kmer_counts[kmer] = kmer_counts.get(kmer, 0) + 1
+                seeds.append((i, r_pos))
+        seeds = [(q_pos, r_pos) for q_pos, r_pos in seeds if kmer_counts[seq[q_pos:q_pos + SEED_LEN]] == 1]
+
+        # Longest increasing subsequence of the reference positions
+        tails, tails_idx, prev = [], [], [-1] * len(seeds)
+        for j, (_, r_pos) in enumerate(seeds):
+            p = bisect_left(tails, r_pos)
+            if p > 0:
+                prev[j] = tails_idx[p - 1]
+            if p == len(tails):
+                tails.append(r_pos)
+                tails_idx.append(j)
+            else:
+                tails[p], tails_idx[p] = r_pos, j
+
+        chain = []
+        j = tails_idx[-1] if tails_idx else -1
+        while j >= 0:
+            chain.append(seeds[j])
+            j = prev[j]
+        return chain[::-1]
+
+    def _align_region(self, ref_seq: str, seq: str) -> str:
+        if len(seq) == 0:
+            return '-' * len(ref_seq)
+        if len(ref_seq) == 0:
+            return ''
+        _stats['aligned_regions'] += 1
+        if is_ungapped(ref_seq, seq):
+            _stats['ungapped_regions'] += 1
+            return seq
+        return project_alignment(self.aligner.align(ref_seq, seq)[0].coordinates, seq)
+
+
+def is_ungapped(ref_seq: str, seq: str) -> bool:
+    '''
+    Whether the optimal alignment of a sequence to the reference is the ungapped one, i.e. the two are as long and
+    differ by at most `MAX_UNGAPPED_MISMATCHES` substitutions.
+    '''
+    if len(ref_seq) != len(seq):
+        return False
+    if ref_seq == seq:
+        return True
+    # Non-Latin-1 characters are replaced, and still differ from the nucleotides of the reference
+    ref_codes = np.frombuffer(ref_seq.encode('latin-1', 'replace'), np.uint8)
+    codes = np.frombuffer(seq.encode('latin-1', 'replace'), np.uint8)
+    return np.count_nonzero(ref_codes != codes) <= MAX_UNGAPPED_MISMATCHES
+
+
+def project_alignment(coordinates, seq: str) -> str:
+    '''
+    Project a sequence onto the reference coordinates, given the coordinates of its alignment to the reference (the
+    first row being the reference). Runs in linear time.
+    '''
+    projected = []
+    for (r_start, q_start), (r_end, q_end) in zip(coordinates.T, coordinates.T[1:]):
+        if r_end == r_start:
+            continue
+        projected.append(seq[q_start:q_end] if q_end != q_start else '-' * (r_end - r_start))
+    return ''.join(projected)
+
+
+def kmer_positions(seq: str) -> dict[str, List[int]]:
+    positions = {}
+    for i in range(len(seq) - SEED_LEN + 1):
+        positions.setdefault(seq[i:i + SEED_LEN], []).append(i)
+    return positions
+
+
+def is_repeated(ref_window: str, q_start: int, query_kmers: dict[str, List[int]]) -> bool:
+    '''
+    Whether any k-mer of a reference window occurs in the query other than at the same offset of the query window
+    starting at `q_start`.
+    '''
+    for i in range(len(ref_window) - SEED_LEN + 1):
+        for q_pos in query_kmers.get(ref_window[i:i + SEED_LEN], ()):
+            if q_pos != q_start + i:
+                return True
+    return False
+
+
+def count_matches(window: str, ref_seq: str, r_start: int) -> int:
+    if r_start < 0:
+        return 0
+    return sum(a == b for a, b in zip(window, ref_seq[r_start:r_start + len(window)]))
+
+
+def pop_stats() -> Counter:
+    '''
+    Return the alignment counters accumulated since the last call, and reset them: the number of sequences projected
+    ('alignments') and of those that didn't need to be aligned ('ungapped_alignments'), and the number of regions
+    between anchors ('aligned_regions') and of those that didn't need to be aligned ('ungapped_regions').
+    '''
+    global _stats
+    stats, _stats = _stats, Counter()
+    return stats
+
+
+def summarize_stats(stats: Counter) -> dict[str, Any]:
+    '''
+    Compute the hit rates of the ungapped fast path from the counters returned by `pop_stats()`.
+    '''
+    rate = lambda hits, total: stats[hits] / stats[total] if stats[total] else 0
+    return {
+        'sequences': stats['alignments'],
+        'ungapped_sequences': stats['ungapped_alignments'],
+        'ungapped_sequence_rate': rate('ungapped_alignments', 'alignments'),
+        'regions': stats['aligned_regions'],
+        'ungapped_regions': stats['ungapped_regions'],
+        'ungapped_region_rate': rate('ungapped_regions', 'aligned_regions'),
+    }
+
+
+_ref_aligners: dict[str, ReferenceAligner] = {}
+
+
+def project_to_reference(seg_name: str, seq: str) -> str:
+    '''
+    Align a sequence to the reference of its segment and project it onto the reference coordinates. The aligner of
+    each segment is created once and reused.
+
+    Args:
+        seg_name (str): The name of the segment
+        seq (str): The sequence
+
+    Returns:
+        str: The projected sequence, as long as the reference of the segment
+    '''
+    if (ref_aligner := _ref_aligners.get(seg_name)) is None:
+        ref_aligner = _ref_aligners[seg_name] = ReferenceAligner(alignment_refs[seg_name])
+    return ref_aligner.project(seq)
@@ -0,0 +1,117 @@
+'''
+Calls files: the version predicted for each segment of each sample, saved with `--save-calls` together with the build
+dates of the models that made the calls, so that genotypes can be assigned again when the genotype compositions change
+(see `genin2 reassign`) without aligning and classifying the sequences again.
+
+A calls file is a TSV file, optionally gzipped, whose first line identifies the format and the models:
+
+    #genin2-calls	version=1	models=<build date>	di_models=<build date>
+
+followed by a header and a row per sample, with the version, the warnings, the decision margin and the sub-genotype
+vote of each segment.
+'''
+import gzip
+from typing import Iterator, NamedTuple, TextIO, Tuple
+from genin2.di_discriminator import vote_subgenotype
+from genin2.predictor import SamplePrediction, SegmentPrediction, CompositionIndex, MARGIN_DECIMALS
+from genin2.utils import alignment_refs
+
+
+CALLS_MAGIC = '#genin2-calls'
+CALLS_VERSION = 1
+calls_columns = ['Sample Name'] + [col for seg in alignment_refs.keys() for col in (seg, f'{seg} warnings', f'{seg} margin', f'{seg} DI vote')]
+
+CallsHeader = NamedTuple('CallsHeader', [('ModelsBuildDate', str), ('DIModelsBuildDate', str)])
+SavedCalls = NamedTuple('SavedCalls', [
+    ('SampleName', str),
+    ('Segments', dict[str, SegmentPrediction]),
+    ('DIVotes', dict[str, str]), # Only saved for EA-2024-DI samples
+])
+
+
+class CallsFormatError(Exception):
+    pass
+
+
+def open_calls(path: str, mode: str) -> TextIO:
+    '''
+    Open a calls file for reading ('r') or writing ('w'), compressed with gzip if its name ends with '.gz'.
+    '''
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't')
+    return open(path, mode)
+
+
+def write_header(file: TextIO, header: CallsHeader) -> None:
+    file.write(f'{CALLS_MAGIC}\tversion={CALLS_VERSION}\tmodels={header.ModelsBuildDate}\tdi_models={header.DIModelsBuildDate}\n')
+    file.write('\t'.join(calls_columns) + '\n')
+
+
+def prediction_to_calls(pred: SamplePrediction) -> str:
+    '''
+    Format the segment calls of a prediction as a row of a calls file.
+    '''
+    di_votes = pred.Subgenotype.segments if pred.Subgenotype is not None else {}
+    values = [pred.SampleName]
+    for seg_name in alignment_refs.keys():
+        seg_pred = pred.Segments[seg_name]
+        margin = repr(round(seg_pred.Margin, MARGIN_DECIMALS)) if seg_pred.Margin is not None else ''
+        values.extend((seg_pred.Version, seg_pred.Warnings or '', margin, str(di_votes.get(seg_name, ''))))
+    return '\t'.join(values) + '\n'
+
+
+def read_calls(file: TextIO) -> Tuple[CallsHeader, Iterator[SavedCalls]]:
+    '''
+    Read a calls file. The header is read immediately, the rows lazily.
+
+    Args:
+        file (TextIO): The calls file
+
+    Returns:
+        Tuple[CallsHeader, Iterator[SavedCalls]]: The build dates of the models that made the calls, and the calls of
+            each sample
+
+    Raises:
+        CallsFormatError: If the file is not a calls file, or was written by a newer version of Genin2. Malformed
+            rows are raised while iterating.
+    '''
+    fields = dict(field.split('=', 1) for field in file.readline().rstrip('\n').split('\t')[1:] if '=' in field)
+    if fields.get('version') != str(CALLS_VERSION) or 'models' not in fields or 'di_models' not in fields:
+        raise CallsFormatError("Not a calls file saved by this version of Genin2")
+    columns = file.readline().rstrip('\n').split('\t')
+    if set(columns) != set(calls_columns):
+        raise CallsFormatError("Unexpected columns in the calls file")
+
+    def rows() -> Iterator[SavedCalls]:
+        for line_num, line in enumerate(file, start=3):
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) != len(columns):
+                raise CallsFormatError(f"Line {line_num} of the calls file has {len(fields)} columns instead of {len(columns)}")
+            values = dict(zip(columns, fields))
+            segments, di_votes = {}, {}
+            for seg_name in alignment_refs.keys():
+                margin = float(values[f'{seg_name} margin']) if values[f'{seg_name} margin'] else None
+                segments[seg_name] = SegmentPrediction(values[seg_name], values[f'{seg_name} warnings'], margin)
+                if values[f'{seg_name} DI vote']:
+                    di_votes[seg_name] = values[f'{seg_name} DI vote']
+            yield SavedCalls(values['Sample Name'], segments, di_votes)
+
+    return CallsHeader(fields['models'], fields['di_models']), rows()
+
+
+def reassign_sample(saved: SavedCalls, compositions: CompositionIndex) -> Tuple[SamplePrediction, bool]:
+    '''
+    Assign the genotype of a sample from its saved segment calls, and its sub-genotype from the saved sub-genotype
+    votes of its segments.
+
+    Returns:
+        Tuple[SamplePrediction, bool]: The prediction, and whether the sample is `EA-2024-DI` but its sub-genotype
+            couldn't be predicted, because the sub-genotype votes weren't saved (they are only computed for samples
+            that were `EA-2024-DI` when the calls were made)
+    '''
+    genotype = compositions.assign_genotype(saved.Segments)
+    subgenotype = None
+    if genotype.GenotypeName == 'EA-2024-DI' and saved.DIVotes:
+        subgenotype = vote_subgenotype(saved.DIVotes)
+    missing_subgenotype = genotype.GenotypeName == 'EA-2024-DI' and subgenotype is None
+    return SamplePrediction(saved.SampleName, genotype, subgenotype, saved.Segments), missing_subgenotype
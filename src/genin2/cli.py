@@ -1,17 +1,127 @@
 import click
-from genin2.genin2_core import __version__, __author__, __contact__, run, print_model_info
+from genin2.genin2_core import __version__, __author__, __contact__, run, reassign, print_model_info, OUTPUT_FORMATS
 
 
-@click.command(epilog='')
+class DefaultGroup(click.Group):
+    '''
+    Group of commands that falls back to `run` when the first argument is not the name of a command, so that
+    `genin2 [OPTIONS] INPUT_FILE` keeps working as before.
+    '''
+
+    default_command = 'run'
+
+    def parse_args(self, ctx, args):
+        if not args or args[0] not in self.commands:
+            args = [self.default_command, *args]
+        return super().parse_args(ctx, args)
+
+
+class ShardType(click.ParamType):
+    '''
+    A shard of the input, written as 'i/N' (the i-th of N, starting from 1).
+    '''
+
+    name = 'i/N'
+
+    def convert(self, value, param, ctx):
+        if isinstance(value, tuple):
+            return value
+        try:
+            index, count = (int(n) for n in value.split('/'))
+        except ValueError:
+            self.fail(f"'{value}' is not in the form i/N", param, ctx)
+        if not 1 <= index <= count:
+            self.fail(f"the shard index must be between 1 and {count}", param, ctx)
+        return index, count
+
+
+loglevel_option = click.option('--loglevel', type=click.Choice(['dbg', 'inf', 'wrn', 'err'], case_sensitive=False), default='wrn', help='Verbosity of the logging messages', show_default=True)
+output_format_option = click.option('--output-format', type=click.Choice(OUTPUT_FORMATS, case_sensitive=False), default='tsv', show_default=True, help="With 'tsv-extended' and 'jsonl', also report the decision margin of each segment, the sub-genotype confidence and the sub-genotype votes of each segment")
+
+
+def analysis_options(func):
+    for option in reversed([
+        loglevel_option,
+        click.option('--min-seq-cov', type=click.FloatRange(0, 1), help='The minimum accepted sequence coverage for each gene segment', default=0.7, show_default=True),
+        click.option('--batch-size', type=click.IntRange(min=1), help='Number of samples whose segments are classified together with a single model call', default=256, show_default=True),
+        click.option('--cache', is_flag=True, help='Reuse the predictions of previously analysed sequences, storing new ones in a persistent cache'),
+        click.option('--cache-file', type=click.Path(dir_okay=False), help='Location of the persistent cache  [default: in the user cache directory]'),
+        click.option('--cache-size', type=click.IntRange(min=1), help='Maximum number of sequences kept in the persistent cache', default=1_000_000, show_default=True),
+    ]):
+        func = option(func)
+    return func
+
+
+@click.group(cls=DefaultGroup)
+def start_cli():
+    pass
+
+
+@start_cli.command('run', epilog='To keep the models loaded and serve predictions over HTTP, see: genin2 serve --help. To assign the genotypes of saved calls again, see: genin2 reassign --help')
 @click.help_option('-h', '--help')
 @click.version_option(__version__, '-v', '--version', message=f'%(prog)s, version %(version)s, by {__author__} ({__contact__})')
-@click.argument('input_file', type=click.File('r'), default='-')
+@click.argument('inputs', nargs=-1, type=click.Path(exists=True, allow_dash=True))
 @click.option('--model-info', is_flag=True, help='Show information about models and exit')
-@click.option('-o', '--output-file', type=click.File('w'), help='Output TSV', default='-')
-@click.option('--loglevel', type=click.Choice(['dbg', 'inf', 'wrn', 'err'], case_sensitive=False), default='wrn', help='Verbosity of the logging messages', show_default=True)
-@click.option('--min-seq-cov', type=click.FloatRange(0, 1), help='The minimum accepted sequence coverage for each gene segment', default=0.7, show_default=True)
-def start_cli(input_file: click.File, output_file: click.File, **kwargs):
+@click.option('-o', '--output-file', type=click.Path(dir_okay=False, writable=True, allow_dash=True), help='Output TSV', default='-')
+@output_format_option
+@click.option('--resume', is_flag=True, help='Skip the samples that are already in the output file (and in the calls file), appending the others. Use it from the first run, so that the output is regularly synced to disk')
+@click.option('--shard', type=ShardType(), help='Only analyse the i-th of N disjoint subsets of the samples, chosen by the hash of their names, to split a large input across jobs')
+@click.option('--save-calls', type=click.Path(dir_okay=False, writable=True), help="Save the segment calls of each sample to this file (gzipped if it ends with '.gz'), to assign the genotypes again when new genotypes are released, with 'genin2 reassign'")
+@analysis_options
+@click.option('-t', '--threads', '--workers', 'threads', type=click.IntRange(min=1), help='Number of worker processes used for the analysis', default=1, show_default=True)
+@click.option('--stream', type=click.Choice(['grouped', 'complete'], case_sensitive=False), help="Process samples while reading the input, instead of loading it all first. With 'grouped', the segments of each sample must be contiguous; with 'complete', a sample is processed once all its segments are read (or at the end of the input)")
+@click.option('--profile', is_flag=True, help='Print the time spent in each stage of the analysis')
+@click.option('--metrics-json', type=click.Path(dir_okay=False, writable=True), help='Save the time spent in each stage of the analysis to a JSON file')
+@click.option('--profiler', type=click.Path(dir_okay=False, writable=True), help="Profile the whole run with cProfile and save the statistics to this file (or an HTML report with pyinstrument, if it ends with '.html'). Only the main process is profiled")
+def run_cmd(inputs, output_file: str, **kwargs):
+    '''
+    Predict the genotypes of the samples in INPUTS: FASTA files, optionally compressed with gzip, bgzip, xz or bzip2,
+    or directories containing them (default: standard input).
+    '''
     if kwargs['model_info']:
         print_model_info()
+    elif kwargs['profiler'] is not None:
+        from genin2.metrics import profile, ProfilerError
+        try:
+            with profile(kwargs['profiler']):
+                run(inputs, output_file, **kwargs)
+        except ProfilerError as e:
+            raise click.ClickException(str(e))
     else:
-        run(input_file, output_file, **kwargs)
+        run(inputs, output_file, **kwargs)
+
+
+@start_cli.command('serve')
+@click.help_option('-h', '--help')
+@click.option('--host', help='Address to listen on', default='127.0.0.1', show_default=True)
+@click.option('-p', '--port', type=click.IntRange(0, 65535), help='TCP port to listen on', default=8000, show_default=True)
+@click.option('--socket', 'unix_socket', type=click.Path(dir_okay=False), help='Listen on this Unix socket instead of a TCP port (an existing socket is replaced, other files are not)')
+@click.option('--batch-window', type=click.FloatRange(min=0), help='Milliseconds to wait for concurrent requests to be classified together', default=10, show_default=True)
+@analysis_options
+def serve_cmd(**kwargs):
+    '''
+    Keep the models loaded and serve predictions over HTTP.
+
+    \b
+    Endpoints:
+      POST /predict  FASTA input, returns TSV (or ?format=json, tsv-extended, jsonl)
+      GET  /health   Status and model build dates
+      GET  /metrics  Queue depth, batch sizes and latency of each stage
+    '''
+    from genin2.server import serve
+    serve(**kwargs)
+
+
+@start_cli.command('reassign')
+@click.help_option('-h', '--help')
+@click.argument('calls_files', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option('-o', '--output-file', type=click.File('w'), help='Output TSV', default='-')
+@output_format_option
+@click.option('--compositions', type=click.Path(exists=True, dir_okay=False), help='Table of genotype compositions to use instead of the one included in Genin2')
+@loglevel_option
+def reassign_cmd(calls_files, output_file: click.File, **kwargs):
+    '''
+    Assign the genotypes of the samples in CALLS_FILES, saved with 'genin2 --save-calls', using the current genotype
+    compositions, without analysing the sequences again.
+    '''
+    reassign(calls_files, output_file, **kwargs)
@@ -0,0 +1,313 @@
+'''
+Lightweight predictors for the segment models, that evaluate the exported parameters of the scikit-learn estimators
+with NumPy, so that scikit-learn is only imported in the rare cases in which its own computation is needed.
+
+The SVC models use a polynomial kernel on one-hot encoded sequences: the dot product of two encoded sequences is the
+number of bits they have in common, which is computed exactly on bit-packed rows. The decision values differ from
+those of libsvm only by rounding, as the sums are computed in a different order; when a decision is within the
+rounding error from the threshold, the row is classified by the original estimator instead, so that the predictions
+are always the same as scikit-learn's. The random forests are evaluated by traversing the exported trees, with the
+same rule for near ties.
+'''
+import logging
+import numpy as np
+from typing import Any, Optional, Tuple
+
+
+EPS = np.finfo(np.float64).eps
+CHUNK_WORDS = 1 << 22 # Maximum size of the intermediate arrays of the bitwise dot products, in 64-bit words
+VALIDATION_RATES = (0.01, 0.05, 0.2) # Fraction of positions changed in the mutated copies of the validation corpus
+
+
+class CompiledModel:
+    '''
+    Base class of the compiled models. Like the scikit-learn estimators they replace, they have a `classes_` attribute
+    and a `predict()` method; `predict_with_scores()` also returns the scores of each class from the same pass.
+
+    Args:
+        classes (np.ndarray): The classes of the estimator
+        n_features (int): The number of columns of the encoded sequences
+        source (Tuple[str, str]): The model file and the segment name of the estimator, used to load it when needed
+    '''
+
+    def __init__(self, classes: np.ndarray, n_features: int, source: Tuple[str, str]):
+        self.classes_ = np.asarray(classes)
+        self.n_features_in_ = n_features
+        self.source = source
+        self._estimator = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_estimator'] = None
+        return state
+
+    def estimator(self) -> Any:
+        '''
+        Return the scikit-learn estimator the model was compiled from, loading it on first use.
+        '''
+        if self._estimator is None:
+            from genin2.model_cache import load_estimators
+            self._estimator = load_estimators(self.source[0])[self.source[1]]
+        return self._estimator
+
+    def predict(self, X: np.ndarray) -> np.ndarray:
+        return self.predict_with_scores(X)[0]
+
+    def predict_with_scores(self, X: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        '''
+        Predict the class of each row of `X`, and compute the scores of the classes.
+
+        Args:
+            X (np.ndarray): The one-hot encoded sequences, one per row
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: The predicted classes, and the scores in the format of the estimator's
+                `decision_function()` (SVC) or `predict_proba()` (random forests)
+
+        Raises:
+            ValueError: If the number of columns of `X` doesn't match the number of features of the model
+        '''
+        X = np.asarray(X)
+        if X.ndim != 2 or X.shape[1] != self.n_features_in_:
+            raise ValueError(f"Expected a matrix with {self.n_features_in_} columns, got shape {X.shape}")
+
+        rows = binary_rows(X)
+        if rows is None:
+            # Not one-hot encoded: none of the shortcuts apply
+            estimator = self.estimator()
+            return estimator.predict(X), self._estimator_scores(estimator, X)
+
+        class_idxs, scores, ambiguous = self._predict(rows)
+        labels = self.classes_[class_idxs]
+        if ambiguous.any():
+            logging.debug("%s %s: %d rows too close to a decision boundary, classifying them with scikit-learn", *self.source, ambiguous.sum())
+            estimator = self.estimator()
+            labels[ambiguous] = estimator.predict(X[ambiguous])
+            scores[ambiguous] = self._estimator_scores(estimator, X[ambiguous])
+        return labels, scores
+
+    def _predict(self, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        raise NotImplementedError
+
+    def _estimator_scores(self, estimator: Any, X: np.ndarray) -> np.ndarray:
+        raise NotImplementedError
+
+
+class CompiledSVC(CompiledModel):
+    '''
+    Multi-class SVC with a polynomial kernel, evaluated as libsvm does: one-vs-one decisions, each won by the first
+    class of the pair if its value is positive, then a vote in which ties go to the class that comes first.
+    '''
+
+    def __init__(self, svc: Any, source: Tuple[str, str]):
+        support_vectors = binary_rows(np.asarray(svc.support_vectors_))
+        if svc.kernel != 'poly' or support_vectors is None:
+            raise ValueError("Only polynomial kernels on one-hot encoded features can be compiled")
+        super().__init__(svc.classes_, support_vectors.shape[1], source)
+
+        self.support_vectors = pack_rows(support_vectors)
+        self.gamma = float(svc._gamma)
+        self.coef0 = float(svc.coef0)
+        self.degree = int(svc.degree)
+
+        # The coefficients of each pair of classes (i, j) are those of the support vectors of the two classes, that
+        # libsvm stores in rows j-1 and i of the dual coefficients respectively
+        n_classes = len(self.classes_)
+        starts = np.concatenate([[0], np.cumsum(svc.n_support_)])
+        self.pairs = np.array([(i, j) for i in range(n_classes) for j in range(i + 1, n_classes)], dtype=np.intp)
+        self.pair_coef = np.zeros((len(support_vectors), len(self.pairs)))
+        for p, (i, j) in enumerate(self.pairs):
+            self.pair_coef[starts[i]:starts[i + 1], p] = svc._dual_coef_[j - 1, starts[i]:starts[i + 1]]
+            self.pair_coef[starts[j]:starts[j + 1], p] = svc._dual_coef_[i, starts[j]:starts[j + 1]]
+        self.intercept = np.array(svc._intercept_, dtype=np.float64)
+
+    def _predict(self, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        kernel = (self.gamma * bitwise_dots(pack_rows(rows), self.support_vectors) + self.coef0) ** self.degree
+        dec = kernel @ self.pair_coef + self.intercept
+
+        # Bound of the rounding errors of both computations: the kernel powers and the sums of the terms
+        error = (np.abs(kernel) @ np.abs(self.pair_coef) + np.abs(self.intercept)) * (len(self.pair_coef) + self.degree + 8) * 2 * EPS
+        ambiguous = (np.abs(dec) <= error).any(axis=1)
+
+        winners = np.where(dec > 0, self.pairs[:, 0], self.pairs[:, 1])
+        votes = (winners[:, :, np.newaxis] == np.arange(len(self.classes_))).sum(axis=1)
+        return votes.argmax(axis=1), self._decision_function(dec), ambiguous
+
+    def _decision_function(self, dec: np.ndarray) -> np.ndarray:
+        # Same as SVC.decision_function() with decision_function_shape='ovr'
+        if len(self.classes_) == 2:
+            return -dec[:, 0]
+        votes = np.zeros((len(dec), len(self.classes_)))
+        confidences = np.zeros((len(dec), len(self.classes_)))
+        for p, (i, j) in enumerate(self.pairs):
+            confidences[:, i] += dec[:, p]
+            confidences[:, j] -= dec[:, p]
+            votes[:, i] += dec[:, p] >= 0
+            votes[:, j] += dec[:, p] < 0
+        return votes + confidences / (3 * (np.abs(confidences) + 1))
+
+    def decision_function(self, X: np.ndarray) -> np.ndarray:
+        return self.predict_with_scores(X)[1]
+
+    def _estimator_scores(self, estimator: Any, X: np.ndarray) -> np.ndarray:
+        return estimator.decision_function(X)
+
+
+class CompiledForest(CompiledModel):
+    '''
+    Random forest classifier, whose trees are stored as flat arrays of nodes. Each leaf points to itself, so that all
+    the trees are traversed together for a fixed number of steps.
+    '''
+
+    def __init__(self, forest: Any, source: Tuple[str, str]):
+        super().__init__(forest.classes_, forest.n_features_in_, source)
+        trees = [estimator.tree_ for estimator in forest.estimators_]
+        if any(tree.n_outputs != 1 for tree in trees):
+            raise ValueError("Only single-output forests can be compiled")
+
+        offsets = np.concatenate([[0], np.cumsum([tree.node_count for tree in trees])])
+        self.roots = offsets[:-1].astype(np.intp)
+        self.max_depth = max(tree.max_depth for tree in trees)
+        self.feature = np.empty(offsets[-1], dtype=np.intp)
+        self.threshold = np.empty(offsets[-1])
+        self.children = np.empty((2, offsets[-1]), dtype=np.intp)
+        self.proba = np.empty((offsets[-1], len(self.classes_)))
+        for tree, offset in zip(trees, offsets):
+            nodes = np.arange(tree.node_count)
+            leaves = tree.children_left == -1
+            self.feature[offset + nodes] = np.where(leaves, 0, tree.feature)
+            self.threshold[offset + nodes] = tree.threshold
+            self.children[0, offset + nodes] = offset + np.where(leaves, nodes, tree.children_left)
+            self.children[1, offset + nodes] = offset + np.where(leaves, nodes, tree.children_right)
+            # As DecisionTreeClassifier.predict_proba()
+            proba = tree.value[:, 0, :len(self.classes_)].copy()
+            normalizer = proba.sum(axis=1)[:, np.newaxis]
+            normalizer[normalizer == 0.0] = 1.0
+            self.proba[offset + nodes] = proba / normalizer
+
+    def _predict(self, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        nodes = np.broadcast_to(self.roots, (len(rows), len(self.roots)))
+        sample_idxs = np.arange(len(rows))[:, np.newaxis]
+        for _ in range(self.max_depth):
+            go_right = rows[sample_idxs, self.feature[nodes]] > self.threshold[nodes]
+            nodes = self.children[go_right.astype(np.intp), nodes]
+
+        proba = self.proba[nodes].sum(axis=1) / len(self.roots)
+        # The estimator sums the trees in the order in which they are evaluated by its threads
+        top2 = np.sort(proba, axis=1)[:, -2:] if len(self.classes_) > 1 else np.zeros((len(rows), 2))
+        ambiguous = top2[:, 1] - top2[:, 0] <= len(self.roots) * 4 * EPS
+        return proba.argmax(axis=1), proba, ambiguous
+
+    def predict_proba(self, X: np.ndarray) -> np.ndarray:
+        return self.predict_with_scores(X)[1]
+
+    def _estimator_scores(self, estimator: Any, X: np.ndarray) -> np.ndarray:
+        return estimator.predict_proba(X)
+
+
+def predict_with_scores(model: Any, X: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Predict the classes of the rows of `X` and compute their scores with either a compiled model, in a single pass, or
+    a scikit-learn estimator (SVC or random forest).
+    '''
+    if isinstance(model, CompiledModel):
+        return model.predict_with_scores(X)
+    scores = model.decision_function(X) if hasattr(model, 'decision_function') else model.predict_proba(X)
+    return model.predict(X), scores
+
+
+def binary_rows(X: np.ndarray) -> Optional[np.ndarray]:
+    '''
+    Return `X` as a boolean matrix, or None if it contains values other than 0 and 1.
+    '''
+    if X.dtype == bool:
+        return X
+    if ((X == 0) | (X == 1)).all():
+        return X != 0
+    return None
+
+
+def pack_rows(rows: np.ndarray) -> np.ndarray:
+    '''
+    Pack the rows of a boolean matrix in 64-bit words.
+    '''
+    packed = np.packbits(rows, axis=1)
+    if packed.shape[1] % 8 != 0:
+        packed = np.pad(packed, ((0, 0), (0, 8 - packed.shape[1] % 8)))
+    return np.ascontiguousarray(packed).view(np.uint64)
+
+
+def bitwise_dots(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    '''
+    Compute the dot products of each row of `a` with each row of `b`, two matrices of bit-packed boolean rows.
+
+    Returns:
+        np.ndarray: A matrix of shape (len(a), len(b))
+    '''
+    dots = np.empty((len(a), len(b)), dtype=np.float64)
+    step = max(1, CHUNK_WORDS // max(1, b.size))
+    for start in range(0, len(a), step):
+        common = a[start:start + step, np.newaxis, :] & b[np.newaxis, :, :]
+        dots[start:start + step] = np.bitwise_count(common).sum(axis=2, dtype=np.int32)
+    return dots
+
+
+def compile_model(estimator: Any, source: Tuple[str, str]) -> CompiledModel:
+    '''
+    Export the parameters of a fitted estimator to a compiled model.
+
+    Args:
+        estimator (Any): A fitted SVC or RandomForestClassifier
+        source (Tuple[str, str]): The model file and the segment name of the estimator
+
+    Returns:
+        CompiledModel: The compiled model
+
+    Raises:
+        ValueError: If the estimator (or its configuration) is not supported
+    '''
+    from sklearn.ensemble import RandomForestClassifier
+    from sklearn.svm import SVC
+
+    if isinstance(estimator, SVC) and estimator.decision_function_shape == 'ovr' and not estimator.break_ties:
+        compiled = CompiledSVC(estimator, source)
+    elif isinstance(estimator, RandomForestClassifier):
+        compiled = CompiledForest(estimator, source)
+    else:
+        raise ValueError(f"Unsupported estimator: {estimator!r}")
+    compiled._estimator = estimator
+    return compiled
+
+
+def validate(compiled: CompiledModel, estimator: Any, X: np.ndarray) -> bool:
+    '''
+    Check that a compiled model returns the same predictions as the estimator it was compiled from, and the same
+    scores up to rounding, on a validation corpus.
+    '''
+    labels, scores = compiled.predict_with_scores(X)
+    expected_scores = compiled._estimator_scores(estimator, X)
+    return bool(np.array_equal(labels, estimator.predict(X)) and np.allclose(scores, expected_scores, rtol=1e-9, atol=1e-12))
+
+
+def validation_corpus(support_vectors: np.ndarray, seed: int = 0) -> np.ndarray:
+    '''
+    Build a validation corpus from the support vectors of a segment's SVC, which are encoded sequences of each
+    version, and copies of them in which a fraction of the positions is replaced by a random nucleotide, a gap or an N.
+
+    Args:
+        support_vectors (np.ndarray): The support vectors, with 4 one-hot columns per position
+        seed (int): The seed of the random mutations
+
+    Returns:
+        np.ndarray: The boolean corpus, one sequence per row
+    '''
+    rng = np.random.default_rng(seed)
+    symbols = np.vstack([np.eye(4, dtype=bool), np.zeros(4, dtype=bool), np.ones(4, dtype=bool)])
+    original = np.asarray(support_vectors) != 0
+    corpus = [original]
+    for rate in VALIDATION_RATES:
+        mutated = original.copy().reshape(len(original), -1, 4)
+        mask = rng.random(mutated.shape[:2]) < rate
+        mutated[mask] = symbols[rng.integers(len(symbols), size=mask.sum())]
+        corpus.append(mutated.reshape(len(original), -1))
+    return np.vstack(corpus)
@@ -1,6 +1,10 @@
-import importlib_resources, joblib
+import numpy as np
 from collections import namedtuple
-from genin2.utils import alignment_refs, pairwise_alignment, encode_sequence
+from typing import List, Optional
+from genin2.model_cache import load_models, load_build_date
+from genin2.result_cache import ResultCache
+from genin2.aligner import project_to_reference
+from genin2.utils import alignment_refs, encode_sequence, EncodedSample
 
 
 n_segs = len(alignment_refs.keys())
@@ -9,15 +13,59 @@ SubgenotypePrediction = namedtuple('SubgenotypePrediction', ['subgenotype', 'con
 
 class DIDiscriminator:
     def __init__(self):
-        self.dd_models = joblib.load(importlib_resources.files('genin2').joinpath('dd.xz'))
-        self.model_build_date = self.dd_models['build_date']
+        # The models are only needed for EA-2024-DI samples, and are loaded on first use
+        self.model_build_date = load_build_date('dd.xz')
+        self.cache: Optional[ResultCache] = None
+        self._dd_models = None
+
+    @property
+    def dd_models(self):
+        if self._dd_models is None:
+            self._dd_models = load_models('dd.xz')
+        return self._dd_models
     
     def predict_sample(self, sample):
-        segments_pred = {sn: self._predict_segment(sn, nt) for sn, nt in sample.items()}
-        subg_scores = {subg: list(segments_pred.values()).count(subg) / n_segs for subg in set(segments_pred.values())}
-        subgenotype = max(subg_scores.items(), key=lambda x: x[1])
-        return SubgenotypePrediction(subgenotype[0], subgenotype[1], segments_pred)
-
-    def _predict_segment(self, seg_name, seg_seq):
-        aligned = pairwise_alignment(alignment_refs[seg_name], seg_seq)
-        return self.dd_models[seg_name].predict([encode_sequence(aligned)])[0]
+        encoded = {sn: encode_sequence(project_to_reference(sn, nt)) for sn, nt in sample.items()}
+        return self.predict_encoded([encoded])[0]
+
+    def predict_encoded(self, encoded_samples: List[EncodedSample], samples: Optional[List[dict[str, str]]] = None) -> List[SubgenotypePrediction]:
+        # Segments that are already aligned and encoded are stacked and classified with one call per segment model.
+        # When the raw sequences are also given, cached predictions are reused and the segments that were not encoded
+        # by the genotype prediction (because their version was cached) are aligned here.
+        segments_preds = [{} for _ in encoded_samples]
+        for seg_name in alignment_refs.keys():
+            idxs, rows = [], []
+            for i, encoded in enumerate(encoded_samples):
+                seq = samples[i].get(seg_name) if samples is not None else None
+                if seq is not None and self.cache is not None and (label := self.cache.get_di_label(seg_name, seq)) is not None:
+                    segments_preds[i][seg_name] = label
+                elif seg_name in encoded:
+                    idxs.append(i)
+                    rows.append(encoded[seg_name])
+                elif seq is not None:
+                    idxs.append(i)
+                    rows.append(encode_sequence(project_to_reference(seg_name, seq)))
+            if len(idxs) == 0:
+                continue
+
+            for i, pred in zip(idxs, self.dd_models[seg_name].predict(np.stack(rows))):
+                segments_preds[i][seg_name] = pred
+                if samples is not None and self.cache is not None:
+                    self.cache.put_di_label(seg_name, samples[i][seg_name], str(pred))
+        return [vote_subgenotype(segments_pred) for segments_pred in segments_preds]
+
+
+def vote_subgenotype(segments_pred: dict[str, str]) -> SubgenotypePrediction:
+    '''
+    Predict the sub-genotype of a sample as the one predicted for most of its segments. The confidence is the fraction
+    of segments that voted for it; ties go to the first sub-genotype in alphabetical order.
+
+    Args:
+        segments_pred (dict[str, str]): The sub-genotype predicted for each segment
+
+    Returns:
+        SubgenotypePrediction: The prediction
+    '''
+    subg_scores = {subg: list(segments_pred.values()).count(subg) / n_segs for subg in sorted(set(segments_pred.values()))}
+    subgenotype = max(subg_scores.items(), key=lambda x: x[1])
+    return SubgenotypePrediction(subgenotype[0], subgenotype[1], segments_pred)
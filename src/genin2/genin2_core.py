@@ -1,26 +1,48 @@
-from click import File
-import importlib_resources, joblib, sys, csv, logging, time
-from typing import List, Tuple, Optional, Any, NamedTuple
+from click import File, open_file
+import io, json, os, sys, logging, time
+from collections import Counter, deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Callable, Iterable, Iterator, List, Tuple, Optional, Any, TextIO, Union
 import genin2.update_checker as update_checker
+import genin2.aligner as aligner
+import genin2.calls as calls
+import genin2.metrics as metrics
+import genin2.predictor
 from genin2.di_discriminator import DIDiscriminator
-from genin2.utils import alignment_refs, read_fasta, pairwise_alignment, encode_sequence, \
-    InvalidEncoding
+from genin2.inputs import expand_inputs, read_inputs
+from genin2.model_cache import load_build_date
+from genin2.predictor import Genin2Predictor, GenotypePrediction, SegmentPrediction, SamplePrediction, DataLoadError, \
+    CompositionIndex, MIN_SEQ_COV, BATCH_SIZE, load_compositions, MARGIN_DECIMALS
+from genin2.result_cache import ResultCache
+from genin2.resume import resume_output, ResumeError, CHECKPOINT_INTERVAL
+from genin2.utils import alignment_refs, read_fasta, chunked, chunked_available, in_shard, user_cache_dir, EncodedSample
+import numpy as np
 
 
 __version__ = '2.1.6'
 __author__ = 'Alessandro Sartori'
 __contact__ = 'asartori@izsvenezie.it'
 
-MIN_SEQ_COV = 0.7 # Minimum fraction of valid input NTs wrt the total length of the ref seq
-MAX_COMPATIBLE_GENS = 3 # Maximum number of compatible genotypes to accept. If the prediction returns more, all will be discarded as unreliable
-
+# The module-level functions use a shared predictor, created by `init_data()`. `MIN_SEQ_COV`, `BATCH_SIZE` and
+# `result_cache` can be changed at any time and apply to the following predictions.
+predictor: Optional[Genin2Predictor] = None
 genotype2versions: dict[str, dict[str, str]] = {}
-models: dict[str, Any]
+models: dict[str, Any] = {}
 output_segments_order = ['PB2', 'PB1', 'PA', 'NP', 'NA', 'MP', 'NS']
-di_discr: DIDiscriminator
-
-GenotypePrediction = NamedTuple('GenotypePrediction', [('GenotypeName', str), ('Warnings', Optional[str])])
-SegmentPrediction = NamedTuple('SegmentPrediction', [('Version', str), ('Warnings', Optional[str])])
+output_columns = ['Sample Name', 'Genotype', 'Sub-genotype'] + output_segments_order + ['Notes']
+# Columns added by the extended output formats, for quality control: the decision margin of each segment's version,
+# and the confidence and the per-segment votes of the sub-genotype prediction
+extended_columns = output_columns + [f'{seg} margin' for seg in output_segments_order] + ['Sub-genotype confidence'] + \
+    [f'{seg} DI vote' for seg in output_segments_order]
+OUTPUT_FORMATS = ['tsv', 'tsv-extended', 'jsonl']
+# Not used anymore, as the genotypes are assigned by `Genin2Predictor`: kept for backward compatibility with code that
+# reads it from this module, as in previous versions. Changing it has no effect.
+MAX_COMPATIBLE_GENS = genin2.predictor.MAX_COMPATIBLE_GENS
+STREAM_POLL_INTERVAL = 0.1 # Seconds between checks for finished chunks of the workers, while waiting for streamed input
+di_discr: Optional[DIDiscriminator] = None
+result_cache: Optional[ResultCache] = None
+
+_worker_error: Optional[Exception] = None
 
 
 def critical_error(msg: str, ex: Optional[Exception] = None) -> None:
@@ -41,7 +63,7 @@ def critical_error(msg: str, ex: Optional[Exception] = None) -> None:
 
 
 def print_model_info() -> None:
-    import numpy, sklearn, Bio
+    import numpy, sklearn, joblib, Bio
     init_data()
     print(f"Genin2 core ... {__version__}")
     print(f"Genotypes ..... {len(genotype2versions.keys())} entries")
@@ -57,142 +79,187 @@ def print_model_info() -> None:
     print(f"Biopython ..... {Bio.__version__}")
 
 
+def init_logging(loglevel: str) -> None:
+    logging.basicConfig(
+        level={'dbg': logging.DEBUG, 'inf': logging.INFO, 'wrn': logging.WARN, 'err': logging.ERROR}[loglevel],
+        format='[%(levelname)s] %(message)s',
+        stream=sys.stderr
+    )
+
+
+def apply_settings(**kwargs) -> None:
+    '''
+    Apply the analysis options given on the command line: minimum sequence coverage, batch size and result cache.
+    Must be called after `init_data()`.
+    '''
+    global MIN_SEQ_COV, BATCH_SIZE
+
+    if 'min_seq_cov' in kwargs:
+        MIN_SEQ_COV = kwargs['min_seq_cov']
+
+    if kwargs.get('batch_size') is not None:
+        BATCH_SIZE = kwargs['batch_size']
+
+    if kwargs.get('cache'):
+        cache_file = kwargs.get('cache_file') or user_cache_dir().joinpath('results.sqlite')
+        logging.info("Using result cache at %s", cache_file)
+        set_result_cache(ResultCache(cache_file, kwargs['cache_size'], str(models['build_date']), str(di_discr.model_build_date)))
+
+
 def init_data() -> None:
     '''
     Load the compositions table and the prediction models. If an error occurs, a critical error is raised.
     '''
-    global genotype2versions, models, di_discr
-
     try:
-        comp_file = csv.reader(
-            importlib_resources.files('genin2').joinpath('compositions.tsv').open('r'),
-            delimiter='\t'
-        )
-        cols = next(comp_file)
+        load_data()
+    except DataLoadError as e:
+        critical_error(str(e), e.__cause__)
 
-        for line in comp_file:
-            genotype2versions[line[0]] = {seg: ver for seg, ver in zip(cols[1:], line[1:])}
-    except Exception as e:
-        critical_error("Couldn't load genotype compositions", e)
 
-    try:
-        models = joblib.load(
-            importlib_resources.files('genin2').joinpath('models.xz')
-        )
-        logging.debug(f'Model build date: {models["build_date"]}')
-    except Exception as e:
-        critical_error("Couldn't load prediction models", e)
+def load_data() -> None:
+    '''
+    Load the compositions table and the prediction models into the shared predictor.
 
-    try:
-        di_discr = DIDiscriminator()
-        logging.debug(f'DI discriminator models build date: {di_discr.model_build_date}')
-    except Exception as e:
-        critical_error("Couldn't load DI discriminator models", e)
+    Raises:
+        DataLoadError: If any of the data files could not be loaded. The original exception is set as the cause.
+    '''
+    global predictor, genotype2versions, models, di_discr
 
+    predictor = Genin2Predictor(MIN_SEQ_COV, BATCH_SIZE, result_cache)
+    genotype2versions, models, di_discr = predictor.genotype2versions, predictor.models, predictor.di_discr
 
-def predict_sample(sample: dict[str, str]) -> Tuple[GenotypePrediction, dict[str, SegmentPrediction]]:
-    ver_predictions: dict[str, SegmentPrediction] = {}
-    low_confidence = False
-
-    for seg_name, seq in sample.items():        
-        seq_cov = (len(seq) - seq.upper().count('N')) / len(alignment_refs[seg_name])
-        if (seq_cov < MIN_SEQ_COV):
-            ver_predictions[seg_name] = SegmentPrediction('?', f'low quality ({int(seq_cov*100)}% valid)')
-            low_confidence = True
-            continue
-        
-        seg_pred = predict_seg_version(seg_name, seq)
-        logging.debug(f"{seg_name:3s} -> ({seg_pred.Version}, {seg_pred.Warnings})")
-        ver_predictions[seg_name] = seg_pred
-        if seg_pred.Warnings != '':
-            low_confidence = True
-    
-    for seg_name in alignment_refs.keys():
-        if seg_name not in ver_predictions:
-            ver_predictions[seg_name] = SegmentPrediction('?', 'missing')
-            low_confidence = True
-
-    genotype = GenotypePrediction('', 'internal error')
-    compatibles = get_compatible_genotypes({s: (pred.Version if pred.Warnings == '' else '?') for s, pred in ver_predictions.items()})
-    if len(compatibles) == 1 and not low_confidence:
-        genotype = GenotypePrediction(compatibles[0], None)
-    elif len(compatibles) == 0:
-        genotype = GenotypePrediction('[unassigned]', 'unknown composition')
-    elif len(compatibles) > MAX_COMPATIBLE_GENS:
-        genotype = GenotypePrediction('[unassigned]', 'insufficient data')
-    else:
-        genotype = GenotypePrediction('[unassigned]', f'compatible with {", ".join(compatibles)}')
 
+def default_predictor() -> Genin2Predictor:
+    '''
+    Return the predictor used by the module-level functions, loading it if needed, with the current values of
+    `MIN_SEQ_COV`, `BATCH_SIZE` and `result_cache`.
+
+    Raises:
+        DataLoadError: If the predictor had to be loaded and any of the data files could not be loaded
+    '''
+    if predictor is None:
+        load_data()
+    predictor.min_seq_cov, predictor.batch_size = MIN_SEQ_COV, BATCH_SIZE
+    if predictor.cache is not result_cache:
+        predictor.set_cache(result_cache)
+    return predictor
+
+
+def init_worker(loglevel: int, min_seq_cov: float, batch_size: int, cache: Optional[ResultCache], collect_metrics: bool) -> None:
+    '''
+    Initializer of the worker processes. When the process was forked, the models are inherited from the parent and are
+    not loaded again. Loading errors are not raised here, as they would only result in a broken pool, but are re-raised
+    by `process_chunk_worker()` so that they reach the parent process.
+
+    Args:
+        loglevel (int): The logging level of the parent process
+        min_seq_cov (float): The value of `MIN_SEQ_COV` in the parent process
+        batch_size (int): The value of `BATCH_SIZE` in the parent process
+        cache (Optional[ResultCache]): The result cache of the parent process. Each worker opens its own connection.
+        collect_metrics (bool): Whether the parent process collects stage timings
+    '''
+    global MIN_SEQ_COV, BATCH_SIZE, _worker_error
+    logging.basicConfig(level=loglevel, format='[%(levelname)s] %(message)s', stream=sys.stderr)
+    MIN_SEQ_COV, BATCH_SIZE = min_seq_cov, batch_size
+    if collect_metrics:
+        metrics.enable()
+
+    if predictor is None:
+        try:
+            load_data()
+        except DataLoadError as e:
+            _worker_error = e
+    set_result_cache(cache)
+
+
+def set_result_cache(cache: Optional[ResultCache]) -> None:
+    '''
+    Enable (or, with None, disable) the persistent cache of segment predictions.
+    '''
+    global result_cache
+    result_cache = cache
+
+
+def process_chunk_worker(chunk: List[Tuple[str, dict[str, str]]]) -> Tuple[List[SamplePrediction], Counter]:
+    if _worker_error is not None:
+        raise _worker_error
+    return process_chunk(chunk)
+
+
+def predict_sample(sample: dict[str, str]) -> Tuple[GenotypePrediction, dict[str, SegmentPrediction]]:
+    genotype, ver_predictions, _ = predict_samples([('', sample)])[0]
     return genotype, ver_predictions
 
 
+def predict_samples(samples: List[Tuple[str, dict[str, str]]]) -> List[Tuple[GenotypePrediction, dict[str, SegmentPrediction], EncodedSample]]:
+    return default_predictor().predict_versions(samples)
+
+
+def assign_genotype(ver_predictions: dict[str, SegmentPrediction]) -> GenotypePrediction:
+    return default_predictor().assign_genotype(ver_predictions)
+
+
 def predict_seg_version(seg_name: str, seq: str) -> SegmentPrediction:
-    try:
-        encoded_seq = pairwise_alignment(alignment_refs[seg_name], seq)
-        encoded_seq = encode_sequence(encoded_seq)
-    except InvalidEncoding as ex:
-        logging.error(f"Failed to encode {seg_name}. {str(ex)}")
-        return SegmentPrediction('?', 'nucleotide encoding error')
-    except Exception as ex:
-        logging.error(f"Failed to align and encode {seg_name} sequence. {type(ex).__name__}, {str(ex)}")
-        return SegmentPrediction('?', 'model error')
-
-    model = models[seg_name]
-    prediction = model.predict([encoded_seq])[0]
-    if logging.root.level <= logging.DEBUG:
-        classes = ' '.join(f'{c:>6s}' for c in model.classes_)
-        logging.debug(f"{seg_name:3s} df: {classes}")
-        df = model.decision_function([encoded_seq])[0]
-        df = [df] if isinstance(df, float) else df
-        df = ','.join(f'{v:6.2f}' for v in df)
-        logging.debug(f"{seg_name:3s}     {df}")
-    return SegmentPrediction(prediction, '' if prediction != '?' else 'unassigned')
+    return default_predictor().predict_seg_version(seg_name, seq)
+
+
+def classify_segments(seg_name: str, encoded_seqs: np.ndarray) -> List[SegmentPrediction]:
+    return default_predictor().classify_segments(seg_name, encoded_seqs)
 
 
 def get_compatible_genotypes(versions: dict[str, str]) -> List[str]:
+    return default_predictor().get_compatible_genotypes(versions)
+
+
+def parse_header(header: str) -> Optional[Tuple[str, str]]:
     '''
-    Get all compatible genotypes based on the provided versions. If no genotypes are compatible, an empty list is returned.
+    Split a FASTA header into sample name and segment name. Invalid headers and segments that are not analysed are
+    reported and discarded.
 
     Args:
-        versions (dict[str, str]): A dict mapping each segment to the most likely version. '?' is trated as an unknown version.
+        header (str): The FASTA header, without the leading '>'
 
     Returns:
-        List[str]: The list of genotypes that are compatible with the given versions. Might be an empty list.
+        Optional[Tuple[str, str]]: The sample name and the segment name, or None if the sequence should be discarded
     '''
+    try:
+        name, seg_name = header.rsplit('_', 1)
+    except:
+        logging.error("Discarding sequence, invalid FASTA header: %s", header)
+        return None
+
+    if seg_name not in alignment_refs.keys():
+        if seg_name != 'HA' and seg_name != 'MP':
+            logging.warning("Segment '%s' in sample '%s' is not recognized", seg_name, name)
+        return None
+
+    return name, seg_name
 
-    gset = genotype2versions
-    for s, v in versions.items():
-        if v != '?':
-            gset = {gen: comp for gen, comp in gset.items() if comp[s] == v}
-    
-    return list(gset.keys())
 
+def fasta_records(source: Union[File, Iterable[Tuple[str, str]]]) -> Iterable[Tuple[str, str]]:
+    # The (header, sequence) records of a FASTA file handle, or records that were already parsed (see `read_inputs()`)
+    return read_fasta(source) if hasattr(source, 'read') else source
 
-def preload_samples(file: File) -> dict[str, dict[str, str]]:
+
+def preload_samples(file: Union[File, Iterable[Tuple[str, str]]]) -> dict[str, dict[str, str]]:
     '''
     Load all samples contained in a FASTA file into a dictionary. The keys are the sample names and the values are dictionaries
     mapping each segment to the corresponding sequence.
 
     Args:
-        file (File): A file handle of a FASTA file
+        file (Union[File, Iterable[Tuple[str, str]]]): A file handle of a FASTA file, or the (header, sequence) records
+            read from one or more FASTA files by `read_inputs()`
 
     Returns:
         dict[str, dict[str, str]]: A dictionary mapping each sample name to a dictionary of segments and sequences
     '''
     samples = {}
 
-    for name, seq in read_fasta(file):
-        try:
-            name, seg_name = name.rsplit('_', 1)
-        except:
-            logging.error("Discarding sequence, invalid FASTA header: %s", name)
+    for header, seq in fasta_records(file):
+        if (parsed := parse_header(header)) is None:
             continue
-        
-        if seg_name not in alignment_refs.keys():
-            if seg_name != 'HA' and seg_name != 'MP':
-                logging.warning("Segment '%s' in sample '%s' is not recognized", seg_name, name)
-            continue
-        
+        name, seg_name = parsed
+
         if name not in samples:
             samples[name] = {}
 
@@ -203,6 +270,52 @@ def preload_samples(file: File) -> dict[str, dict[str, str]]:
     return samples
 
 
+def stream_samples(file: Union[File, Iterable[Tuple[str, str]]], mode: str) -> Iterator[Tuple[str, dict[str, str]]]:
+    '''
+    Read the samples contained in a FASTA file one at a time, yielding each of them as soon as it is complete. Only the
+    samples still waiting for some of their segments are kept in memory. The ones left incomplete at the end of the
+    file are yielded last.
+
+    Args:
+        file (Union[File, Iterable[Tuple[str, str]]]): A file handle of a FASTA file, or the (header, sequence) records
+            read from one or more FASTA files by `read_inputs()`
+        mode (str): 'grouped' if all segments of a sample are contiguous in the file, so that a sample is complete as
+            soon as a different sample name is found; 'complete' to wait until all the segments in `alignment_refs`
+            of a sample have been read, regardless of their order
+
+    Returns:
+        Iterator[Tuple[str, dict[str, str]]]: The (sample name, {segment: sequence}) pairs
+    '''
+    pending: dict[str, dict[str, str]] = {}
+    done = set()
+
+    for header, seq in fasta_records(file):
+        if (parsed := parse_header(header)) is None:
+            continue
+        name, seg_name = parsed
+
+        if name in done:
+            logging.warning("Segment %s for sample %s was found after the sample was processed (discarding)", seg_name, name)
+            continue
+
+        if mode == 'grouped' and name not in pending:
+            for prev_name in list(pending.keys()):
+                done.add(prev_name)
+                yield prev_name, pending.pop(prev_name)
+
+        sample = pending.setdefault(name, {})
+        if seg_name in sample:
+            logging.warning("Segment %s for sample %s was defined multiple times (keeping the last)", seg_name, name)
+        sample[seg_name] = seq
+
+        if mode == 'complete' and len(sample) == len(alignment_refs):
+            done.add(name)
+            yield name, pending.pop(name)
+
+    for name, sample in pending.items():
+        yield name, sample
+
+
 def prediction_to_tsv(sample_name, genotype, subgenotype, genotype_notes, ver_predictions):
     tsv_row, notes_col = [], []
     if genotype_notes is not None:
@@ -219,49 +332,280 @@ def prediction_to_tsv(sample_name, genotype, subgenotype, genotype_notes, ver_pr
     return tsv_row
 
 
-def run(in_file: File, out_file: File, **kwargs):
-    # fmt_log = lambda lvl, msg: f"[{lvl}] {msg}"
-    logging.basicConfig(
-        level={'dbg': logging.DEBUG, 'inf': logging.INFO, 'wrn': logging.WARN, 'err': logging.ERROR}[kwargs['loglevel']],
-        format='[%(levelname)s] %(message)s',
-        stream=sys.stderr
-    )
+def prediction_to_row(pred: SamplePrediction) -> List[Any]:
+    '''
+    Convert a prediction to the values of `extended_columns`: the TSV columns of `prediction_to_tsv()`, followed by
+    the margins, the sub-genotype confidence and the DI votes, which are None when not available.
+    '''
+    subgenotype = pred.Subgenotype.subgenotype if pred.Subgenotype is not None else None
+    row: List[Any] = prediction_to_tsv(pred.SampleName, pred.Genotype.GenotypeName, subgenotype, pred.Genotype.Warnings, pred.Segments)
+    row.extend(pred.Segments[seg].Margin for seg in output_segments_order)
+    row.append(pred.Subgenotype.confidence if pred.Subgenotype is not None else None)
+    di_votes = pred.Subgenotype.segments if pred.Subgenotype is not None else {}
+    row.extend(str(di_votes[seg]) if seg in di_votes else None for seg in output_segments_order)
+    return row
+
+
+def output_header(output_format: str) -> Optional[str]:
+    if output_format == 'jsonl':
+        return None
+    return '\t'.join(extended_columns if output_format == 'tsv-extended' else output_columns)
+
+
+def write_output_header(out_file: File, output_format: str) -> None:
+    header = output_header(output_format)
+    if header is not None:
+        out_file.write(header + '\n')
+
+
+def format_row(row: List[Any], output_format: str) -> str:
+    '''
+    Format a row of `extended_columns` values as a line of output, in one of the `OUTPUT_FORMATS`: the standard TSV
+    columns, all the TSV columns, or a JSON object keyed by column name.
+    '''
+    if output_format == 'tsv':
+        return '\t'.join(row[:len(output_columns)]) + '\n'
+    elif output_format == 'tsv-extended':
+        return '\t'.join('' if v is None else f'{v:.{MARGIN_DECIMALS}f}' if isinstance(v, float) else v for v in row) + '\n'
+    elif output_format == 'jsonl':
+        row = [round(v, MARGIN_DECIMALS) if isinstance(v, float) else v for v in row]
+        return json.dumps(dict(zip(extended_columns, row))) + '\n'
+    raise ValueError(f"Unknown output format '{output_format}'")
+
+
+def process_chunk(chunk: List[Tuple[str, dict[str, str]]]) -> Tuple[List[SamplePrediction], Counter]:
+    '''
+    Predict genotypes and sub-genotypes for a chunk of samples.
+
+    Args:
+        chunk (List[Tuple[str, dict[str, str]]]): A list of (sample name, {segment: sequence}) pairs
+
+    Returns:
+        Tuple[List[SamplePrediction], Counter]: The predictions, in the same order as the input, and the run statistics
+            collected while processing the chunk
+    '''
+    predictions = default_predictor().predict_batch(chunk)
+
+    stats = aligner.pop_stats()
+    if result_cache is not None:
+        stats += result_cache.pop_stats()
+    stats += metrics.pop_stats()
+    return predictions, stats
+
+
+def map_chunks(chunks: Iterable[List[Tuple[str, dict[str, str]]]], threads: int) -> Iterator[Tuple[List[Tuple[str, dict[str, str]]], Tuple[List[SamplePrediction], Counter]]]:
+    '''
+    Process chunks of samples, either in the current process or spread over a pool of worker processes. Results are
+    always yielded in the same order as the input chunks, and exceptions raised by the workers are propagated.
+
+    Args:
+        chunks (Iterable[List[Tuple[str, dict[str, str]]]]): The chunks of (sample name, {segment: sequence}) pairs.
+            Empty chunks are skipped: while waiting for input, they let the results of the workers be yielded.
+        threads (int): The number of worker processes. With 1, no pool is created.
+
+    Returns:
+        Iterator[Tuple[List[Tuple[str, dict[str, str]]], Tuple[List[SamplePrediction], Counter]]]: Each chunk together with
+            the result of `process_chunk()`
+    '''
+    if threads <= 1:
+        for chunk in chunks:
+            if chunk:
+                yield chunk, process_chunk(chunk)
+        return
+
+    executor = ProcessPoolExecutor(threads, initializer=init_worker, initargs=(logging.root.level, MIN_SEQ_COV, BATCH_SIZE, result_cache, metrics.enabled()))
+    try:
+        yield from imap_ordered(executor, process_chunk_worker, chunks, 2 * threads)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def imap_ordered(executor: Executor, fn: Callable[[Any], Any], items: Iterable[Any], window: int) -> Iterator[Tuple[Any, Any]]:
+    '''
+    Like `Executor.map()`, but never keeps more than `window` tasks in flight, so that `items` is consumed lazily. The
+    results are yielded as soon as they are ready, rather than when the window is full; empty items are not submitted,
+    and only give the chance to yield the results that became ready while waiting for the next item.
+
+    Returns:
+        Iterator[Tuple[Any, Any]]: Each item together with the result of `fn(item)`, in the same order as the input
+    '''
+    pending = deque()
+    for item in items:
+        if item:
+            pending.append((item, executor.submit(fn, item)))
+        while pending and (len(pending) >= window or pending[0][1].done()):
+            done_item, future = pending.popleft()
+            yield done_item, future.result()
+
+    while pending:
+        item, future = pending.popleft()
+        yield item, future.result()
+
+
+def select_samples(samples: Iterable[Tuple[str, dict[str, str]]], done: set[str], shard: Optional[Tuple[int, int]]) -> Iterator[Tuple[str, dict[str, str]]]:
+    '''
+    Skip the samples that were already analysed by an interrupted run, and the ones that belong to other shards.
+
+    Args:
+        samples (Iterable[Tuple[str, dict[str, str]]]): The samples, as (name, segments) pairs
+        done (set[str]): The names of the samples already analysed
+        shard (Optional[Tuple[int, int]]): The shard to analyse, as (index, count) with 1 <= index <= count, or None to
+            analyse all samples
+    '''
+    for name, sample in samples:
+        if name not in done and (shard is None or in_shard(name, *shard)):
+            yield name, sample
+
+
+def sync_outputs(*files: Optional[TextIO]) -> None:
+    # Make sure that the outputs written so far survive a crash, so that the run can be resumed from them
+    for file in files:
+        if file is not None:
+            file.flush()
+            os.fsync(file.fileno())
+
+
+def run(inputs: List[str], out_path: str, **kwargs):
+    init_logging(kwargs['loglevel'])
+    if kwargs.get('resume') and (kwargs.get('save_calls') or '').endswith('.gz'):
+        critical_error("--resume requires an uncompressed calls file, use --save-calls with a name that doesn't end with '.gz'")
     logging.info("Initializing")
     update_checker.start_check()
     init_data()
+    apply_settings(**kwargs)
+
+    in_files = expand_inputs(inputs or ['-'])
+    if not in_files:
+        critical_error("No input files found")
+
+    output_format = kwargs.get('output_format') or 'tsv'
+    calls_path = kwargs.get('save_calls')
+    calls_header = calls.CallsHeader(str(models['build_date']), str(di_discr.model_build_date))
+    resume = kwargs.get('resume', False)
+    done: set[str] = set()
+    if resume:
+        if out_path == '-':
+            critical_error("An output file (-o) is required to resume a run")
+        for path in (out_path, calls_path):
+            if path is not None and os.path.exists(path) and not os.path.isfile(path):
+                critical_error(f"--resume requires regular files, '{path}' is not")
+        try:
+            done = resume_output(out_path, output_header(output_format), calls_path, calls_header)
+        except ResumeError as e:
+            critical_error(str(e))
+        except Exception as e:
+            critical_error(f"Couldn't read the output of the interrupted run from '{out_path}'", e)
 
-    if 'min_seq_cov' in kwargs:
-        global MIN_SEQ_COV
-        MIN_SEQ_COV = kwargs['min_seq_cov']
-
+    # When resuming, the outputs are appended to, and their headers are only written if they are empty
     try:
-        out_file.write('Sample Name\tGenotype\tSub-genotype\t' + '\t'.join(output_segments_order) + '\tNotes\n')
+        out_file = open_file(out_path, 'a' if resume else 'w')
+        if not resume or out_file.tell() == 0:
+            write_output_header(out_file, output_format)
+            out_file.flush() # Readers of a streamed output see the header before the first rows are ready
+    except io.UnsupportedOperation:
+        critical_error(f"--resume requires the output to be a regular file, '{out_path}' is not")
     except Exception as e:
-        critical_error(f"Couldn't write to output file '{out_file}'", e)
+        critical_error(f"Couldn't write to output file '{out_path}'", e)
 
-    logging.info("Preloading samples")
-    start_time = time.time()
-    samples = preload_samples(in_file)
-    logging.info("Read %d samples in %.1f seconds", len(samples), time.time() - start_time)
+    calls_file = None
+    if calls_path:
+        try:
+            calls_file = calls.open_calls(calls_path, 'a' if resume else 'w')
+            if not resume or calls_file.tell() == 0:
+                calls.write_header(calls_file, calls_header)
+                calls_file.flush()
+        except io.UnsupportedOperation:
+            critical_error(f"--resume requires the calls file to be a regular file, '{calls_path}' is not")
+        except Exception as e:
+            critical_error(f"Couldn't write to calls file '{calls_path}'", e)
+
+    if kwargs.get('profile') or kwargs.get('metrics_json'):
+        metrics.enable()
+    run_start = time.perf_counter()
+
+    threads = kwargs.get('threads') or 1
+    shard = kwargs.get('shard')
+    records = read_inputs(in_files)
+    if kwargs.get('stream') is not None:
+        logging.info("Streaming samples")
+        # Each chunk holds the samples that are complete by the time the previous one is processed, up to BATCH_SIZE,
+        # so that rows are written as soon as their sample is complete even if the input arrives slowly (e.g. a pipe)
+        samples = select_samples(stream_samples(records, kwargs['stream']), done, shard)
+        chunks = metrics.timed('read_fasta', chunked_available(samples, BATCH_SIZE, STREAM_POLL_INTERVAL if threads > 1 else None), len)
+    else:
+        logging.info("Preloading samples")
+        start_time = time.time()
+        read_start = time.perf_counter()
+        try:
+            samples = preload_samples(records)
+        except Exception as e:
+            critical_error("Couldn't read the input files", e)
+        metrics.record('read_fasta', read_start, len(samples))
+        logging.info("Read %d samples in %.1f seconds", len(samples), time.time() - start_time)
+        samples = list(select_samples(samples.items(), done, shard))
+        if done or shard is not None:
+            logging.info("%d samples left to analyse", len(samples))
+        chunks = chunked(samples, max(1, min(BATCH_SIZE, -(-len(samples) // threads))))
 
     logging.info("Starting analysis...")
     start_time = time.time()
-    tot_seqs = 0
-    for sample_name, sample in samples.items():
-        logging.info(f"Processing {len(sample)} segments for {sample_name}")
-        tot_seqs += len(sample)
-
-        subgenotype = None
-        (genotype, genotype_notes), ver_predictions = predict_sample(sample)
-        if genotype == 'EA-2024-DI':
-            subgenotype = di_discr.predict_sample(sample).subgenotype
-        
-        tsv_row = prediction_to_tsv(sample_name, genotype, subgenotype, genotype_notes, ver_predictions)
-        out_file.write('\t'.join(tsv_row) + '\n')
+    tot_samples, tot_seqs, stats = 0, 0, Counter()
+    last_sync = time.monotonic()
+    try:
+        for chunk, (predictions, chunk_stats) in map_chunks(chunks, threads):
+            stats += chunk_stats
+            tot_samples += len(chunk)
+            tot_seqs += sum(len(sample) for _, sample in chunk)
+            write_start = time.perf_counter()
+            for pred in predictions:
+                out_file.write(format_row(prediction_to_row(pred), output_format))
+                if calls_file is not None:
+                    calls_file.write(calls.prediction_to_calls(pred))
+            out_file.flush()
+            if calls_file is not None:
+                calls_file.flush()
+            if resume and time.monotonic() - last_sync >= CHECKPOINT_INTERVAL:
+                sync_outputs(out_file, calls_file)
+                last_sync = time.monotonic()
+            metrics.record('write_output', write_start, len(predictions))
+        if resume:
+            sync_outputs(out_file, calls_file)
+        if calls_file is not None:
+            calls_file.close()
+        if out_path != '-':
+            out_file.close()
+    except Exception as e:
+        critical_error("Couldn't complete the analysis", e)
 
     tot_time_s = time.time() - start_time
     h, m, s = (tot_time_s // 3600, tot_time_s % 3600 // 60, tot_time_s % 3600 % 60)
-    logging.info(f"Processed {len(samples)} samples ({tot_seqs} sequences) in {h:.0f}h {m:.0f}m {s:.1f}s")
+    cache_info = f", result cache: {stats['cache_hits']} hits, {stats['cache_misses']} misses" if result_cache is not None else ''
+    logging.info(f"Processed {tot_samples} samples ({tot_seqs} sequences) in {h:.0f}h {m:.0f}m {s:.1f}s{cache_info}")
+    alignment = aligner.summarize_stats(stats)
+    logging.info(
+        "Ungapped alignment fast path: %d of %d sequences (%.1f%%), %d of %d regions between anchors (%.1f%%)",
+        alignment['ungapped_sequences'], alignment['sequences'], alignment['ungapped_sequence_rate'] * 100,
+        alignment['ungapped_regions'], alignment['regions'], alignment['ungapped_region_rate'] * 100
+    )
+
+    if metrics.enabled():
+        stats += metrics.pop_stats()
+        wall_time = time.perf_counter() - run_start
+        summary = metrics.summarize(stats)
+        if kwargs.get('profile'):
+            metrics.print_summary(summary, wall_time)
+            print(
+                f"Ungapped alignments: {alignment['ungapped_sequence_rate'] * 100:.1f}% of sequences, "
+                f"{alignment['ungapped_region_rate'] * 100:.1f}% of regions between anchors", file=sys.stderr
+            )
+        if kwargs.get('metrics_json'):
+            try:
+                metrics.write_json(
+                    kwargs['metrics_json'], summary, version=__version__, samples=tot_samples, sequences=tot_seqs,
+                    threads=threads, wall_time_s=wall_time, alignment=alignment
+                )
+            except Exception as e:
+                critical_error(f"Couldn't write the metrics to '{kwargs['metrics_json']}'", e)
 
     latest_version = update_checker.get_result()
     if latest_version is not None and str(latest_version) != str(__version__):
@@ -288,3 +632,50 @@ def run(in_file: File, out_file: File, **kwargs):
   ╰─────────────────────────────────────────────────╯
 
 ''')
+
+
+def reassign(calls_files: List[str], out_file: File, **kwargs) -> None:
+    '''
+    Assign the genotypes of the samples in calls files saved by `run` with `--save-calls`, using the current genotype
+    compositions (or those in the `compositions` file), without analysing the sequences again. The calls must have been
+    made with the installed models.
+    '''
+    init_logging(kwargs['loglevel'])
+    try:
+        compositions = CompositionIndex(load_compositions(kwargs.get('compositions')))
+    except Exception as e:
+        critical_error("Couldn't load genotype compositions", e)
+    installed_models = calls.CallsHeader(load_build_date('models.xz'), load_build_date('dd.xz'))
+
+    output_format = kwargs.get('output_format') or 'tsv'
+    try:
+        write_output_header(out_file, output_format)
+    except Exception as e:
+        critical_error(f"Couldn't write to output file '{out_file}'", e)
+
+    start_time = time.time()
+    tot_samples, missing_subgenotypes = 0, 0
+    for calls_path in calls_files:
+        try:
+            with calls.open_calls(calls_path, 'r') as calls_file:
+                header, saved_calls = calls.read_calls(calls_file)
+                if header != installed_models:
+                    critical_error(
+                        f"The calls in '{calls_path}' were made with different models (build dates {header.ModelsBuildDate}, "
+                        f"{header.DIModelsBuildDate}) than the installed ones: analyse the samples again instead"
+                    )
+                for saved in saved_calls:
+                    pred, missing_subgenotype = calls.reassign_sample(saved, compositions)
+                    out_file.write(format_row(prediction_to_row(pred), output_format))
+                    tot_samples += 1
+                    missing_subgenotypes += missing_subgenotype
+        except Exception as e:
+            critical_error(f"Couldn't reassign the samples in '{calls_path}'", e)
+    out_file.flush()
+
+    if missing_subgenotypes > 0:
+        logging.warning(
+            "%d samples are now EA-2024-DI, but their sub-genotype wasn't saved: analyse them again to predict it",
+            missing_subgenotypes
+        )
+    logging.info("Reassigned %d samples in %.1f seconds", tot_samples, time.time() - start_time)
@@ -0,0 +1,109 @@
+'''
+Input files: FASTA files, optionally compressed, and directories containing them. Decompression and parsing run in a
+background thread, so that they overlap with the analysis of the samples already read.
+'''
+import bz2, gzip, logging, lzma, os, queue, sys, threading
+from typing import BinaryIO, Iterable, Iterator, List, Tuple
+from genin2.utils import read_fasta_chunks
+
+
+FASTA_EXTENSIONS = ('.fa', '.fasta', '.fas', '.fna', '.ffn', '.fsa')
+COMPRESSION_EXTENSIONS = ('.gz', '.bgz', '.xz', '.bz2')
+READER_BATCH_SIZE = 1024 # Maximum number of records passed at once from the reader thread
+READER_QUEUE_SIZE = 16 # Batches read ahead of the analysis
+
+
+def expand_inputs(paths: Iterable[str]) -> List[str]:
+    '''
+    Replace each directory in a list of input paths with the FASTA files it contains (recursively, in alphabetical
+    order), recognized by their extension: one of `FASTA_EXTENSIONS`, optionally followed by one of
+    `COMPRESSION_EXTENSIONS`. Files are kept as they are, whatever their extension.
+    '''
+    files = []
+    for path in paths:
+        if path == '-' or not os.path.isdir(path):
+            files.append(path)
+            continue
+
+        found = []
+        for dir_path, dir_names, file_names in os.walk(path):
+            dir_names.sort()
+            found.extend(os.path.join(dir_path, name) for name in sorted(file_names) if is_fasta_name(name))
+        if not found:
+            logging.warning("No FASTA files found in directory '%s'", path)
+        files.extend(found)
+    return files
+
+
+def is_fasta_name(file_name: str) -> bool:
+    stem, ext = os.path.splitext(file_name.lower())
+    if ext in COMPRESSION_EXTENSIONS:
+        stem, ext = os.path.splitext(stem)
+    return ext in FASTA_EXTENSIONS
+
+
+def decompress(raw: BinaryIO) -> BinaryIO:
+    '''
+    Wrap a binary file handle to decompress it, if it's compressed with gzip (or bgzip), xz or bzip2. The compression
+    is detected from the content of the file, not from its name. Closing the returned handle doesn't close `raw`.
+    '''
+    magic = raw.peek(6)[:6]
+    if magic.startswith(b'\x1f\x8b'):
+        return gzip.GzipFile(fileobj=raw) # bgzip files are concatenated gzip members
+    if magic.startswith(b'\xfd7zXZ\x00'):
+        return lzma.LZMAFile(raw)
+    if magic.startswith(b'BZh'):
+        return bz2.BZ2File(raw)
+    return raw
+
+
+def read_inputs(paths: List[str]) -> Iterator[Tuple[str, str]]:
+    '''
+    Read the FASTA records of multiple input files, one file after the other. The files are decompressed and parsed
+    in a background thread, which stays up to `READER_QUEUE_SIZE` batches of records ahead of the consumer. The records
+    of each read are passed on at once, without waiting for more input to fill a batch, so that the records arriving
+    from a pipe are available as soon as they are complete.
+
+    Args:
+        paths (List[str]): The input files ('-' for the standard input), as returned by `expand_inputs`
+
+    Returns:
+        Iterator[Tuple[str, str]]: The (header, sequence) pairs, as returned by `read_fasta`. Errors in reading the
+            files are raised by the iterator.
+    '''
+    batches: queue.Queue = queue.Queue(READER_QUEUE_SIZE)
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def reader() -> None:
+        try:
+            for path in paths:
+                logging.info("Reading '%s'", path)
+                # The standard input is read through a duplicate of its descriptor: worker processes forked while the
+                # read blocks close `sys.stdin` when they start, which would otherwise wait for the lock of the read
+                with open(os.dup(sys.stdin.fileno()) if path == '-' else path, 'rb') as raw:
+                    for records in read_fasta_chunks(decompress(raw)):
+                        for start in range(0, len(records), READER_BATCH_SIZE):
+                            if not put(records[start:start + READER_BATCH_SIZE]):
+                                return
+            put(None)
+        except Exception as e:
+            put(e)
+
+    thread = threading.Thread(target=reader, name='genin2-reader', daemon=True)
+    thread.start()
+    try:
+        while (batch := batches.get()) is not None:
+            if isinstance(batch, Exception):
+                raise batch
+            yield from batch
+    finally:
+        stop.set()
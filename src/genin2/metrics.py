@@ -0,0 +1,184 @@
+import json, logging, math, sys, time
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, Optional, TextIO, TypeVar
+
+
+T = TypeVar('T')
+BUCKETS_PER_OCTAVE = 4 # Resolution of the latency histograms: each bucket spans a factor of 2^(1/4), about 19%
+PERCENTILES = (50, 90, 99)
+
+_stats: Optional[Counter] = None
+
+
+class ProfilerError(Exception):
+    pass
+
+
+def enable() -> None:
+    '''
+    Start collecting stage timings in the current process. Until this is called, `record()` does nothing.
+    '''
+    global _stats
+    if _stats is None:
+        _stats = Counter()
+
+
+def enabled() -> bool:
+    return _stats is not None
+
+
+def record(stage: str, start: float, items: int = 1, seg_name: str = '') -> None:
+    '''
+    Record a call to a stage of the analysis, which started at `start` (a `time.perf_counter()` value) and ended now.
+
+    Args:
+        stage (str): The name of the stage
+        start (float): The start time of the call
+        items (int): The number of items (e.g. sequences) processed by the call
+        seg_name (str): The segment processed by the call, if the stage is run separately for each segment
+    '''
+    if _stats is None:
+        return
+    seconds = time.perf_counter() - start
+    _stats[('time', stage, seg_name)] += seconds
+    _stats[('calls', stage, seg_name)] += 1
+    _stats[('items', stage, seg_name)] += items
+    _stats[('hist', stage, seg_name, math.floor(math.log2(max(seconds, 1e-9)) * BUCKETS_PER_OCTAVE))] += 1
+
+
+def timed(stage: str, items: Iterable[T], count: Optional[Callable[[T], int]] = None) -> Iterator[T]:
+    '''
+    Iterate over `items`, recording the time spent producing each of them (e.g. reading input) as a call to `stage`.
+    If `items` are collections (e.g. chunks of samples), `count` gives the number of items to record for each.
+    '''
+    iterator = iter(items)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        record(stage, start, count(item) if count is not None else 1)
+        yield item
+
+
+def pop_stats() -> Counter:
+    '''
+    Return the timings collected since the last call, and reset them. The counters can be summed with those of other
+    processes.
+    '''
+    global _stats
+    if _stats is None:
+        return Counter()
+    stats, _stats = _stats, Counter()
+    return stats
+
+
+def summarize(stats: Counter) -> dict[str, dict]:
+    '''
+    Compute the totals and the latency percentiles of each stage, overall and for each segment, from the counters
+    collected with `record()`. Percentiles are estimated from histograms, with a resolution of about 19%.
+
+    Returns:
+        dict[str, dict]: The statistics of each stage, in the order in which they were first recorded. Stages that are
+            run separately for each segment include the statistics of each segment under 'segments'.
+    '''
+    hists: dict[tuple, Counter] = {}
+    for key, n in stats.items():
+        if isinstance(key, tuple) and key[0] == 'hist':
+            _, stage, seg_name, bucket = key
+            hists.setdefault((stage, seg_name), Counter())[bucket] += n
+            hists.setdefault((stage, None), Counter())[bucket] += n
+
+    def describe(stage: str, seg_name: Optional[str]) -> dict:
+        match = lambda key: isinstance(key, tuple) and key[0] != 'hist' and key[1] == stage and seg_name in (None, key[2])
+        totals = Counter()
+        for key, n in stats.items():
+            if match(key):
+                totals[key[0]] += n
+        desc = {
+            'calls': totals['calls'],
+            'items': totals['items'],
+            'total_s': totals['time'],
+            'mean_ms': totals['time'] / totals['calls'] * 1000 if totals['calls'] else 0,
+        }
+        desc.update({f'p{p}_ms': percentile(hists.get((stage, seg_name), Counter()), p) * 1000 for p in PERCENTILES})
+        return desc
+
+    summary = {}
+    for key in stats:
+        if isinstance(key, tuple) and key[0] == 'calls' and key[1] not in summary:
+            stage = key[1]
+            summary[stage] = describe(stage, None)
+            seg_names = sorted({k[2] for k in stats if isinstance(k, tuple) and k[0] == 'calls' and k[1] == stage and k[2]})
+            if seg_names:
+                summary[stage]['segments'] = {seg_name: describe(stage, seg_name) for seg_name in seg_names}
+    return summary
+
+
+def percentile(hist: Counter, p: float) -> float:
+    n = sum(hist.values())
+    if n == 0:
+        return 0
+    seen = 0
+    for bucket in sorted(hist):
+        seen += hist[bucket]
+        if seen >= n * p / 100:
+            return 2 ** ((bucket + 0.5) / BUCKETS_PER_OCTAVE) # Geometric center of the bucket
+    return 0
+
+
+def print_summary(summary: dict[str, dict], wall_time: float, file: TextIO = sys.stderr) -> None:
+    '''
+    Print the statistics computed by `summarize()` as a table.
+    '''
+    columns = f"{'calls':>8s} {'items':>8s} {'total s':>9s} {'%':>6s} {'mean ms':>9s}" + ''.join(f" {f'p{p} ms':>9s}" for p in PERCENTILES)
+    print(f"{'Stage':22s} {columns}", file=file)
+
+    def print_row(name: str, desc: dict) -> None:
+        share = desc['total_s'] / wall_time * 100 if wall_time > 0 else 0
+        row = f"{name:22s} {desc['calls']:8d} {desc['items']:8d} {desc['total_s']:9.3f} {share:6.1f} {desc['mean_ms']:9.3f}"
+        print(row + ''.join(f" {desc[f'p{p}_ms']:9.3f}" for p in PERCENTILES), file=file)
+
+    for stage, desc in summary.items():
+        print_row(stage, desc)
+        for seg_name, seg_desc in desc.get('segments', {}).items():
+            print_row(f'  {seg_name}', seg_desc)
+    print(f"Wall time: {wall_time:.3f} s (stages run in worker processes may add up to more than the wall time)", file=file)
+
+
+def write_json(path: str, summary: dict[str, dict], **run_info) -> None:
+    Path(path).write_text(json.dumps({**run_info, 'stages': summary}, indent=2) + '\n')
+
+
+@contextmanager
+def profile(path: str):
+    '''
+    Profile the code run within the context with cProfile, saving the statistics to `path` (they can be inspected with
+    `pstats` or `snakeviz`), or with pyinstrument if `path` ends with '.html'. Only the current process is profiled.
+    '''
+    if path.endswith('.html'):
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            raise ProfilerError("HTML profiles require pyinstrument, which is not installed (pip install pyinstrument)")
+        profiler = Profiler()
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            Path(path).write_text(profiler.output_html())
+            logging.info("Saved the profile to %s", path)
+    else:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(path)
+            logging.info("Saved the profile to %s", path)
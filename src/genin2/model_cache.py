@@ -0,0 +1,216 @@
+import hashlib, importlib.metadata, importlib_resources, json, logging, os, tempfile
+from pathlib import Path
+from typing import Any, Optional
+from genin2.utils import user_cache_dir
+
+
+CACHE_FORMAT = 2 # Bump when the layout of the cached files changes
+BUILD_DATES_FILE = 'build_dates.json' # Build dates of the model files in the package data, to update with them
+
+_uncached_warned = False # Whether the models that couldn't be cached were reported
+
+
+def load_models(file_name: str) -> dict[str, Any]:
+    '''
+    Load the models of a model file shipped with the package, compiled for fast inference (see `compiled_models`).
+    Each model is exported from its scikit-learn estimator and checked against it on a validation corpus; the compiled
+    models are stored in the user cache directory, so that later loads only memory-map their arrays and don't import
+    scikit-learn. Models that cannot be compiled, or whose predictions don't match, are kept as estimators.
+
+    Compiling and validating the models takes longer than loading the estimators, so it's only worth it if the result
+    can be cached: if the cache directory cannot be written, the estimators are returned as they are.
+
+    Args:
+        file_name (str): The name of the model file in the package data (e.g. 'models.xz')
+
+    Returns:
+        dict[str, Any]: The models, keyed by segment name, plus their 'build_date'
+    '''
+    import joblib
+
+    data_file = importlib_resources.files('genin2').joinpath(file_name)
+    cache_file = _cache_path(file_name, data_file.read_bytes(), compiled=True)
+    if cache_file is not None and cache_file.exists():
+        try:
+            return joblib.load(cache_file, mmap_mode='r')
+        except Exception as e:
+            logging.warning("Couldn't load the compiled models at '%s', rebuilding (%s)", cache_file, e)
+
+    estimators = load_estimators(file_name)
+    if cache_file is None:
+        _warn_uncached("the versions of the dependencies are unknown")
+        return estimators
+    if not _is_writable(cache_file.parent):
+        _warn_uncached(f"'{cache_file.parent}' is not writable")
+        return estimators
+
+    try:
+        _write_cache(cache_file, compile_models(file_name, estimators))
+        logging.debug("Stored compiled models at '%s'", cache_file)
+        return joblib.load(cache_file, mmap_mode='r')
+    except Exception as e:
+        _warn_uncached(f"they couldn't be stored in the cache directory: {e}")
+        return estimators
+
+
+def load_estimators(file_name: str) -> dict[str, Any]:
+    '''
+    Load the scikit-learn estimators of a compressed model file shipped with the package. On first use, the estimators
+    are stored uncompressed in the user cache directory; later loads memory-map the cached arrays read-only, so they
+    are almost instantaneous and the pages are shared by all the processes that use the same models.
+
+    If the cache cannot be read or written, the compressed file is loaded directly.
+
+    Args:
+        file_name (str): The name of the model file in the package data (e.g. 'models.xz')
+
+    Returns:
+        dict[str, Any]: The estimators, keyed by segment name, plus their 'build_date'
+    '''
+    import joblib
+
+    data_file = importlib_resources.files('genin2').joinpath(file_name)
+    cache_file = _cache_path(file_name, data_file.read_bytes())
+    if cache_file is not None and cache_file.exists():
+        try:
+            return joblib.load(cache_file, mmap_mode='r')
+        except Exception as e:
+            logging.warning("Couldn't load the cached models at '%s', rebuilding (%s)", cache_file, e)
+
+    models = joblib.load(data_file)
+    if cache_file is not None:
+        try:
+            _write_cache(cache_file, models)
+            logging.debug("Stored uncompressed models at '%s'", cache_file)
+            _remove_stale(cache_file)
+            return joblib.load(cache_file, mmap_mode='r')
+        except Exception as e:
+            logging.debug("Couldn't store the models in the cache directory (%s)", e)
+    return models
+
+
+def compile_models(file_name: str, estimators: dict[str, Any]) -> dict[str, Any]:
+    '''
+    Compile the estimators of a model file, validating each of them on sequences derived from the support vectors of
+    the genotyping SVC of the same segment.
+
+    Args:
+        file_name (str): The name of the model file the estimators were loaded from
+        estimators (dict[str, Any]): The estimators, keyed by segment name, plus their 'build_date'
+
+    Returns:
+        dict[str, Any]: The compiled models, or the estimators that could not be compiled, plus the 'build_date'
+    '''
+    from genin2.compiled_models import compile_model, validate, validation_corpus
+
+    svc_models = estimators if file_name == 'models.xz' else load_estimators('models.xz')
+    models = {}
+    for seg_name, estimator in estimators.items():
+        if seg_name == 'build_date':
+            models[seg_name] = estimator
+            continue
+        try:
+            compiled = compile_model(estimator, (file_name, seg_name))
+            if not validate(compiled, estimator, validation_corpus(svc_models[seg_name].support_vectors_)):
+                raise ValueError("its predictions don't match those of scikit-learn")
+            models[seg_name] = compiled
+        except Exception as e:
+            logging.warning("Couldn't compile the %s model of %s, using scikit-learn (%s)", seg_name, file_name, e)
+            models[seg_name] = estimator
+    return models
+
+
+def load_build_date(file_name: str) -> str:
+    '''
+    Return the build date of a model file without loading the models. The build dates of the model files shipped with
+    the package are listed in `build_dates.json`, together with a hash of each file; if a file doesn't match its hash
+    (e.g. the models were updated but not the list), the date is read from the cache metadata, and the models are
+    only loaded as a last resort.
+
+    Args:
+        file_name (str): The name of the model file in the package data (e.g. 'dd.xz')
+
+    Returns:
+        str: The build date of the models
+    '''
+    package_files = importlib_resources.files('genin2')
+    data = package_files.joinpath(file_name).read_bytes()
+    try:
+        entry = json.loads(package_files.joinpath(BUILD_DATES_FILE).read_text())[file_name]
+        if entry['blake2b'] == hashlib.blake2b(data, digest_size=8).hexdigest():
+            return entry['build_date']
+    except Exception as e:
+        logging.debug("Couldn't read the build date of %s from %s (%s)", file_name, BUILD_DATES_FILE, e)
+
+    cache_file = _cache_path(file_name, data)
+    if cache_file is not None:
+        try:
+            return json.loads(cache_file.with_suffix('.json').read_text())['build_date']
+        except Exception:
+            pass
+    logging.warning("The build date of %s is not listed in %s, loading the models to read it", file_name, BUILD_DATES_FILE)
+    return str(load_estimators(file_name)['build_date'])
+
+
+def _warn_uncached(reason: str) -> None:
+    global _uncached_warned
+    if not _uncached_warned:
+        logging.warning("Using the scikit-learn models, as compiled models are only used when cached (%s)", reason)
+        _uncached_warned = True
+
+
+def _is_writable(cache_dir: Path) -> bool:
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        with tempfile.TemporaryFile(dir=cache_dir):
+            return True
+    except OSError:
+        return False
+
+
+def _cache_path(file_name: str, data: bytes, compiled: bool = False) -> Optional[Path]:
+    # The cached pickles depend on the model file, on the scikit-learn version that unpickles them (or that the
+    # compiled models were validated against), on the genin2 version that compiled them and on the layout
+    from genin2.genin2_core import __version__
+
+    try:
+        sklearn_version = importlib.metadata.version('scikit-learn')
+    except importlib.metadata.PackageNotFoundError:
+        return None
+    key = hashlib.blake2b(data, digest_size=8)
+    key.update(f'{sklearn_version}|{__version__}|{CACHE_FORMAT}'.encode())
+    suffix = '.compiled.joblib' if compiled else '.joblib'
+    return user_cache_dir().joinpath('models', f'{Path(file_name).stem}-{key.hexdigest()}{suffix}')
+
+
+def _write_cache(cache_file: Path, models: dict[str, Any]) -> None:
+    # Both files are written under temporary names and atomically renamed, so that concurrent processes never see
+    # partial files. The metadata is written last, as its presence implies that of the models.
+    import joblib
+
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    for path, write in (
+        (cache_file, lambda f: joblib.dump(models, f)),
+        (cache_file.with_suffix('.json'), lambda f: f.write(json.dumps({'build_date': str(models['build_date'])}).encode())),
+    ):
+        fd, tmp_path = tempfile.mkstemp(dir=cache_file.parent, prefix=f'.{path.name}.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+def _remove_stale(cache_file: Path) -> None:
+    # Files of previous model or scikit-learn versions, compiled or not. Files still mapped by other processes may not
+    # be removable.
+    key = cache_file.name.split('.')[0]
+    stem = key.rsplit('-', 1)[0]
+    for path in cache_file.parent.glob(f'{stem}-*'):
+        if path.name.split('.')[0] != key and path.suffix in ('.joblib', '.json'):
+            try:
+                path.unlink()
+            except OSError:
+                pass
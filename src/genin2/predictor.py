@@ -0,0 +1,400 @@
+import csv, importlib_resources, logging, time
+import genin2.metrics as metrics
+import numpy as np
+from collections.abc import Mapping
+from typing import Any, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
+from genin2.aligner import project_to_reference
+from genin2.compiled_models import predict_with_scores
+from genin2.di_discriminator import DIDiscriminator, SubgenotypePrediction
+from genin2.model_cache import load_models
+from genin2.result_cache import ResultCache
+from genin2.utils import alignment_refs, encode_sequence, chunked, EncodedSample, InvalidEncoding
+
+
+MIN_SEQ_COV = 0.7 # Minimum fraction of valid input NTs wrt the total length of the ref seq
+MAX_COMPATIBLE_GENS = 3 # Maximum number of compatible genotypes to accept. If the prediction returns more, all will be discarded as unreliable
+BATCH_SIZE = 256 # Maximum number of sequences classified with a single call to a segment model
+MARGIN_DECIMALS = 4 # Decimals of the margins written to the outputs, as the last bits vary with the batching of the samples
+
+GenotypePrediction = NamedTuple('GenotypePrediction', [('GenotypeName', str), ('Warnings', Optional[str])])
+SegmentPrediction = NamedTuple('SegmentPrediction', [
+    ('Version', str),
+    ('Warnings', Optional[str]),
+    ('Margin', Optional[float]), # Score of the predicted version minus that of the runner-up, None if not classified
+])
+SamplePrediction = NamedTuple('SamplePrediction', [
+    ('SampleName', str),
+    ('Genotype', GenotypePrediction),
+    ('Subgenotype', Optional[SubgenotypePrediction]), # Only predicted for EA-2024-DI samples
+    ('Segments', dict[str, SegmentPrediction]),
+])
+
+
+class DataLoadError(Exception):
+    pass
+
+
+class Genin2Predictor:
+    '''
+    Genotype predictor that owns its prediction models and settings, so that it can be embedded in other Python
+    programs. The models are loaded once, when the predictor is created, and can then be used for any number of
+    predictions. Errors are raised as exceptions; samples that cannot be classified are reported in the warnings of
+    the predictions, as in the command line tool.
+
+    A predictor can be shared by multiple threads.
+
+    Example:
+        >>> predictor = Genin2Predictor()
+        >>> for pred in predictor.predict_many(samples):
+        ...     print(pred.SampleName, pred.Genotype.GenotypeName)
+
+    Args:
+        min_seq_cov (float): The minimum accepted sequence coverage for each gene segment
+        batch_size (int): Maximum number of samples whose segments are classified together with a single model call
+        cache (Optional[ResultCache]): A persistent cache of segment predictions
+
+    Raises:
+        DataLoadError: If any of the data files could not be loaded. The original exception is set as the cause.
+    '''
+
+    def __init__(self, min_seq_cov: float = MIN_SEQ_COV, batch_size: int = BATCH_SIZE, cache: Optional[ResultCache] = None):
+        self.min_seq_cov = min_seq_cov
+        self.batch_size = batch_size
+
+        try:
+            self.genotype2versions: dict[str, dict[str, str]] = load_compositions()
+            self.compositions = CompositionIndex(self.genotype2versions)
+        except Exception as e:
+            raise DataLoadError("Couldn't load genotype compositions") from e
+
+        try:
+            self.models: dict[str, Any] = load_models('models.xz')
+            logging.debug(f'Model build date: {self.models["build_date"]}')
+        except Exception as e:
+            raise DataLoadError("Couldn't load prediction models") from e
+
+        try:
+            self.di_discr = DIDiscriminator()
+            logging.debug(f'DI discriminator models build date: {self.di_discr.model_build_date}')
+        except Exception as e:
+            raise DataLoadError("Couldn't load DI discriminator models") from e
+
+        self.cache: Optional[ResultCache] = None
+        self.set_cache(cache)
+
+    def set_cache(self, cache: Optional[ResultCache]) -> None:
+        '''
+        Enable (or, with None, disable) the persistent cache of segment predictions.
+        '''
+        self.cache = cache
+        self.di_discr.cache = cache
+
+    def predict(self, sample: dict[str, str], sample_name: str = '') -> SamplePrediction:
+        '''
+        Predict the genotype of a single sample.
+
+        Args:
+            sample (dict[str, str]): The sequence of each segment of the sample
+            sample_name (str): The name of the sample, which is copied to the prediction
+
+        Returns:
+            SamplePrediction: The prediction
+
+        Raises:
+            ValueError: If the sample contains an unknown segment name
+        '''
+        return self.predict_batch([(sample_name, sample)])[0]
+
+    def predict_many(self, samples: Union[Iterable[Tuple[str, dict[str, str]]], Mapping[str, dict[str, str]]]) -> Iterator[SamplePrediction]:
+        '''
+        Predict the genotypes of any number of samples. The input is consumed lazily, in batches of `batch_size`
+        samples, and the predictions are yielded in the same order as the input.
+
+        Args:
+            samples (Iterable[Tuple[str, dict[str, str]]]): The (sample name, {segment: sequence}) pairs, or a mapping
+                from sample names to {segment: sequence} dictionaries
+
+        Yields:
+            SamplePrediction: The prediction of each sample
+
+        Raises:
+            ValueError: If a sample contains an unknown segment name
+        '''
+        if isinstance(samples, Mapping):
+            samples = samples.items()
+        for batch in chunked(samples, self.batch_size):
+            yield from self.predict_batch(batch)
+
+    def predict_batch(self, samples: List[Tuple[str, dict[str, str]]]) -> List[SamplePrediction]:
+        '''
+        Predict the genotypes and, for `EA-2024-DI`, the sub-genotypes of a batch of samples.
+
+        Args:
+            samples (List[Tuple[str, dict[str, str]]]): A list of (sample name, {segment: sequence}) pairs
+
+        Returns:
+            List[SamplePrediction]: The predictions, in the same order as the input
+
+        Raises:
+            ValueError: If a sample contains an unknown segment name
+        '''
+        for sample_name, sample in samples:
+            for seg_name in sample:
+                if seg_name not in alignment_refs:
+                    raise ValueError(f"Unknown segment '{seg_name}' in sample '{sample_name}'")
+        samples = [(sample_name, {seg: seq.upper() for seg, seq in sample.items()}) for sample_name, sample in samples]
+
+        predictions = self.predict_versions(samples)
+        di_idxs = [idx for idx, (genotype, _, _) in enumerate(predictions) if genotype.GenotypeName == 'EA-2024-DI']
+        subgenotypes = [None] * len(samples)
+        start = time.perf_counter()
+        di_preds = self.di_discr.predict_encoded([predictions[idx][2] for idx in di_idxs], [samples[idx][1] for idx in di_idxs])
+        if di_idxs:
+            metrics.record('di_discriminator', start, len(di_idxs))
+        for idx, subg_pred in zip(di_idxs, di_preds):
+            subgenotypes[idx] = subg_pred
+        if self.cache is not None:
+            self.cache.flush()
+
+        return [
+            SamplePrediction(sample_name, genotype, subgenotype, ver_predictions)
+            for (sample_name, _), (genotype, ver_predictions, _), subgenotype in zip(samples, predictions, subgenotypes)
+        ]
+
+    def predict_versions(self, samples: List[Tuple[str, dict[str, str]]]) -> List[Tuple[GenotypePrediction, dict[str, SegmentPrediction], EncodedSample]]:
+        '''
+        Predict the genotypes of a batch of samples. All segments are aligned and encoded first, then the rows belonging
+        to the same segment are stacked together and classified with a single call to the corresponding model.
+
+        Args:
+            samples (List[Tuple[str, dict[str, str]]]): A list of (sample name, {segment: sequence}) pairs
+
+        Returns:
+            List[Tuple[GenotypePrediction, dict[str, SegmentPrediction], EncodedSample]]: The predictions, in the same
+                order as the input, together with the encoded segments of each sample, so that they can be reused by
+                the sub-genotype discriminator
+        '''
+        ver_predictions: List[dict[str, SegmentPrediction]] = [{} for _ in samples]
+        encoded_samples: List[EncodedSample] = [{} for _ in samples]
+        pending: dict[str, Tuple[List[int], List[str]]] = {seg_name: ([], []) for seg_name in alignment_refs.keys()}
+
+        for idx, (sample_name, sample) in enumerate(samples):
+            logging.info(f"Processing {len(sample)} segments for {sample_name}")
+            for seg_name, seq in sample.items():
+                seq_cov = (len(seq) - seq.upper().count('N')) / len(alignment_refs[seg_name])
+                if (seq_cov < self.min_seq_cov):
+                    ver_predictions[idx][seg_name] = SegmentPrediction('?', f'low quality ({int(seq_cov*100)}% valid)', None)
+                    continue
+
+                if self.cache is not None and (cached := self.cache.get_version(seg_name, seq)) is not None:
+                    ver_predictions[idx][seg_name] = version_prediction(*cached)
+                    continue
+
+                start = time.perf_counter()
+                try:
+                    aligned_seq = project_to_reference(seg_name, seq)
+                except Exception as ex:
+                    ver_predictions[idx][seg_name] = encoding_failure(seg_name, ex)
+                    continue
+                finally:
+                    metrics.record('alignment', start, seg_name=seg_name)
+                pending[seg_name][0].append(idx)
+                pending[seg_name][1].append(aligned_seq)
+
+        for seg_name, (aligned_idxs, aligned_seqs) in pending.items():
+            # The encodings are written straight into the matrix that is passed to the model
+            encoded_seqs = np.empty((len(aligned_seqs), 4 * len(alignment_refs[seg_name])), dtype=bool)
+            idxs = []
+            start = time.perf_counter()
+            for idx, aligned_seq in zip(aligned_idxs, aligned_seqs):
+                try:
+                    encode_sequence(aligned_seq, out=encoded_seqs[len(idxs)])
+                except InvalidEncoding as ex:
+                    ver_predictions[idx][seg_name] = encoding_failure(seg_name, ex)
+                    continue
+                encoded_samples[idx][seg_name] = encoded_seqs[len(idxs)]
+                idxs.append(idx)
+            if len(aligned_seqs) > 0:
+                metrics.record('encode_sequence', start, len(aligned_seqs), seg_name)
+            if len(idxs) == 0:
+                continue
+
+            for idx, seg_pred in zip(idxs, self.classify_segments(seg_name, encoded_seqs[:len(idxs)])):
+                logging.debug(f"{samples[idx][0]} {seg_name:3s} -> ({seg_pred.Version}, {seg_pred.Warnings})")
+                ver_predictions[idx][seg_name] = seg_pred
+                if self.cache is not None:
+                    self.cache.put_version(seg_name, samples[idx][1][seg_name], seg_pred.Version, seg_pred.Margin)
+
+        results = []
+        for sample_preds, encoded_sample in zip(ver_predictions, encoded_samples):
+            for seg_name in alignment_refs.keys():
+                if seg_name not in sample_preds:
+                    sample_preds[seg_name] = SegmentPrediction('?', 'missing', None)
+            results.append((self.assign_genotype(sample_preds), sample_preds, encoded_sample))
+        return results
+
+    def assign_genotype(self, ver_predictions: dict[str, SegmentPrediction]) -> GenotypePrediction:
+        return self.compositions.assign_genotype(ver_predictions)
+
+    def predict_seg_version(self, seg_name: str, seq: str) -> SegmentPrediction:
+        if self.cache is not None and (cached := self.cache.get_version(seg_name, seq)) is not None:
+            return version_prediction(*cached)
+
+        try:
+            encoded_seq = align_and_encode(seg_name, seq)
+        except Exception as ex:
+            return encoding_failure(seg_name, ex)
+
+        seg_pred = self.classify_segments(seg_name, encoded_seq[np.newaxis])[0]
+        if self.cache is not None:
+            self.cache.put_version(seg_name, seq, seg_pred.Version, seg_pred.Margin)
+        return seg_pred
+
+    def classify_segments(self, seg_name: str, encoded_seqs: np.ndarray) -> List[SegmentPrediction]:
+        '''
+        Classify a batch of encoded sequences of the same segment. The rows are split in chunks of at most
+        `batch_size` and each chunk is passed to the model with a single call, that returns both the predicted versions
+        and the scores of all versions, from which the margins of the predictions are computed.
+
+        Args:
+            seg_name (str): The name of the segment
+            encoded_seqs (np.ndarray): The aligned and encoded sequences, one per row
+
+        Returns:
+            List[SegmentPrediction]: The predicted versions, in the same order as the input
+        '''
+        model = self.models[seg_name]
+        seg_preds = []
+        for start in range(0, len(encoded_seqs), self.batch_size):
+            chunk = encoded_seqs[start:start + self.batch_size]
+            predict_start = time.perf_counter()
+            predictions, scores = predict_with_scores(model, chunk)
+            metrics.record('predict', predict_start, len(chunk), seg_name)
+            if logging.root.level <= logging.DEBUG:
+                classes = ' '.join(f'{c:>6s}' for c in model.classes_)
+                logging.debug(f"{seg_name:3s} df: {classes}")
+                for df in scores:
+                    df = [df] if isinstance(df, float) else df
+                    df = ','.join(f'{v:6.2f}' for v in df)
+                    logging.debug(f"{seg_name:3s}     {df}")
+            margins = decision_margins(model.classes_, predictions, scores)
+            seg_preds.extend(version_prediction(str(pred), float(margin)) for pred, margin in zip(predictions, margins))
+        return seg_preds
+
+    def get_compatible_genotypes(self, versions: dict[str, str]) -> List[str]:
+        return self.compositions.get_compatible_genotypes(versions)
+
+
+class CompositionIndex:
+    '''
+    Index of the genotype compositions, with a bitset of the genotypes that contain each version of each segment. The
+    genotypes compatible with a set of versions are found by intersecting the bitsets of the versions, so that
+    genotypes can be assigned quickly also without analysing any sequence (e.g. by `genin2 reassign`).
+
+    Args:
+        genotype2versions (dict[str, dict[str, str]]): The version of each segment in each genotype
+    '''
+
+    def __init__(self, genotype2versions: dict[str, dict[str, str]]):
+        self.genotypes = list(genotype2versions.keys())
+        self.all_genotypes = (1 << len(self.genotypes)) - 1
+        self.bitsets: dict[Tuple[str, str], int] = {}
+        for bit, composition in enumerate(genotype2versions.values()):
+            for seg_name, version in composition.items():
+                self.bitsets[(seg_name, version)] = self.bitsets.get((seg_name, version), 0) | (1 << bit)
+
+    def assign_genotype(self, ver_predictions: dict[str, SegmentPrediction]) -> GenotypePrediction:
+        '''
+        Assign a genotype to a sample given the version predicted for each of its segments. A genotype is only assigned
+        when all segments were classified without warnings and a single compatible composition exists.
+
+        Args:
+            ver_predictions (dict[str, SegmentPrediction]): The prediction for each of the segments in `alignment_refs`
+
+        Returns:
+            GenotypePrediction: The assigned genotype, or '[unassigned]' with the reason in the warnings
+        '''
+        low_confidence = any(pred.Warnings != '' for pred in ver_predictions.values())
+        compatibles = self.get_compatible_genotypes({s: (pred.Version if pred.Warnings == '' else '?') for s, pred in ver_predictions.items()})
+        if len(compatibles) == 1 and not low_confidence:
+            return GenotypePrediction(compatibles[0], None)
+        elif len(compatibles) == 0:
+            return GenotypePrediction('[unassigned]', 'unknown composition')
+        elif len(compatibles) > MAX_COMPATIBLE_GENS:
+            return GenotypePrediction('[unassigned]', 'insufficient data')
+        else:
+            return GenotypePrediction('[unassigned]', f'compatible with {", ".join(compatibles)}')
+
+    def get_compatible_genotypes(self, versions: dict[str, str]) -> List[str]:
+        '''
+        Get all compatible genotypes based on the provided versions. If no genotypes are compatible, an empty list is returned.
+
+        Args:
+            versions (dict[str, str]): A dict mapping each segment to the most likely version. '?' is trated as an unknown version.
+
+        Returns:
+            List[str]: The list of genotypes that are compatible with the given versions, in the order of the
+                compositions table. Might be an empty list.
+        '''
+        compatibles = self.all_genotypes
+        for seg_name, version in versions.items():
+            if version != '?':
+                compatibles &= self.bitsets.get((seg_name, version), 0)
+
+        genotypes = []
+        while compatibles:
+            lowest = compatibles & -compatibles
+            genotypes.append(self.genotypes[lowest.bit_length() - 1])
+            compatibles ^= lowest
+        return genotypes
+
+
+def load_compositions(path: Optional[str] = None) -> dict[str, dict[str, str]]:
+    '''
+    Load a table of genotype compositions: a TSV file with a header, a genotype per row, and the version of each
+    segment in the following columns.
+
+    Args:
+        path (Optional[str]): The path of the table. By default, the table shipped with the package is loaded.
+
+    Returns:
+        dict[str, dict[str, str]]: The version of each segment in each genotype
+    '''
+    comp_file = open(path) if path is not None else importlib_resources.files('genin2').joinpath('compositions.tsv').open('r')
+    with comp_file:
+        reader = csv.reader(comp_file, delimiter='\t')
+        cols = next(reader)
+        return {line[0]: {seg: ver for seg, ver in zip(cols[1:], line[1:])} for line in reader}
+
+
+def version_prediction(version: str, margin: Optional[float] = None) -> SegmentPrediction:
+    return SegmentPrediction(version, '' if version != '?' else 'unassigned', margin)
+
+
+def decision_margins(classes: np.ndarray, predictions: np.ndarray, scores: np.ndarray) -> np.ndarray:
+    '''
+    Compute how much the score of the predicted class exceeds the best score of the other classes, given the output of
+    a model's `decision_function()` (a single column for binary models, whose positive values favour the second class).
+    The margin is negative in the rare cases in which the predicted class doesn't have the highest score (e.g. ties in
+    the one-vs-one votes).
+    '''
+    pred_idxs = np.searchsorted(classes, predictions)
+    if scores.ndim == 1:
+        return np.where(pred_idxs == 1, scores, -scores)
+    rows = np.arange(len(scores))
+    others = scores.copy()
+    others[rows, pred_idxs] = -np.inf
+    return scores[rows, pred_idxs] - others.max(axis=1)
+
+
+def align_and_encode(seg_name: str, seq: str) -> np.ndarray:
+    aligned_seq = project_to_reference(seg_name, seq)
+    return encode_sequence(aligned_seq)
+
+
+def encoding_failure(seg_name: str, ex: Exception) -> SegmentPrediction:
+    if isinstance(ex, InvalidEncoding):
+        logging.error(f"Failed to encode {seg_name}. {str(ex)}")
+        return SegmentPrediction('?', 'nucleotide encoding error', None)
+    logging.error(f"Failed to align and encode {seg_name} sequence. {type(ex).__name__}, {str(ex)}")
+    return SegmentPrediction('?', 'model error', None)
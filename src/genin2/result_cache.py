@@ -0,0 +1,141 @@
+import sqlite3, hashlib, logging, os, threading, time
+from collections import Counter
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+
+class ResultCache:
+    '''
+    Persistent cache of segment predictions, stored in a SQLite database. Entries are keyed by segment name and by the
+    hash of the sequence, and are only valid for the model build dates they were computed with: when the models change,
+    the whole cache is invalidated. When the cache grows beyond `max_entries`, the least recently used entries are
+    evicted.
+
+    The database connection is opened lazily in each process, so that the same instance can be inherited by forked
+    workers. Lookups and insertions are buffered and written in a single transaction by `flush()`. Within a process,
+    the cache can be used by multiple threads.
+    '''
+
+    def __init__(self, path: Path, max_entries: int, models_build_date: str, dd_build_date: str):
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self.build_dates = f'{models_build_date}|{dd_build_date}'
+        self.stats = Counter()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pid: Optional[int] = None
+        self._used: List[Tuple[int, str, bytes]] = []
+        self._versions: List[Tuple[str, bytes, str, Optional[float], int]] = []
+        self._di_labels: List[Tuple[str, int, str, bytes]] = []
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Connections, locks and pending writes are never shared with other processes
+        state = self.__dict__.copy()
+        state.update(stats=Counter(), _conn=None, _pid=None, _used=[], _versions=[], _di_labels=[])
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def get_version(self, seg_name: str, seq: str) -> Optional[Tuple[str, Optional[float]]]:
+        '''
+        Return the cached version of a segment sequence together with its decision margin (None for entries stored by
+        older versions of Genin2), or None if the sequence is not cached.
+        '''
+        return self._get(seg_name, seq, 'version, margin')
+
+    def get_di_label(self, seg_name: str, seq: str) -> Optional[str]:
+        row = self._get(seg_name, seq, 'di_label')
+        return row[0] if row is not None else None
+
+    def put_version(self, seg_name: str, seq: str, version: str, margin: Optional[float] = None) -> None:
+        with self._lock:
+            self._versions.append((seg_name, seq_hash(seq), version, margin, time.time_ns()))
+
+    def put_di_label(self, seg_name: str, seq: str, di_label: str) -> None:
+        with self._lock:
+            self._di_labels.append((di_label, time.time_ns(), seg_name, seq_hash(seq)))
+
+    def pop_stats(self) -> Counter:
+        '''
+        Return the hit/miss counters accumulated since the last call, and reset them.
+        '''
+        with self._lock:
+            stats, self.stats = self.stats, Counter()
+        return stats
+
+    def flush(self) -> None:
+        '''
+        Write the buffered insertions and access times to the database, then evict the least recently used entries if
+        the cache is over its size limit.
+        '''
+        with self._lock:
+            if not (self._used or self._versions or self._di_labels):
+                return
+
+            conn = self._connection()
+            with conn:
+                conn.executemany('UPDATE results SET last_used = ? WHERE segment = ? AND seq_hash = ?', self._used)
+                conn.executemany(
+                    'INSERT INTO results (segment, seq_hash, version, margin, last_used) VALUES (?, ?, ?, ?, ?) '
+                    'ON CONFLICT (segment, seq_hash) DO UPDATE SET version = excluded.version, margin = excluded.margin, '
+                    'last_used = excluded.last_used',
+                    self._versions
+                )
+                conn.executemany('UPDATE results SET di_label = ?, last_used = ? WHERE segment = ? AND seq_hash = ?', self._di_labels)
+
+                n_entries = conn.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+                if n_entries > self.max_entries:
+                    # Evict some extra entries, so that the next few flushes don't have to evict again
+                    n_evict = n_entries - int(self.max_entries * 0.9)
+                    conn.execute('DELETE FROM results WHERE rowid IN (SELECT rowid FROM results ORDER BY last_used LIMIT ?)', (n_evict,))
+                    logging.debug("Evicted %d entries from the result cache", n_evict)
+
+            self._used.clear()
+            self._versions.clear()
+            self._di_labels.clear()
+
+    def _get(self, seg_name: str, seq: str, columns: str) -> Optional[tuple]:
+        # The first column must be set for the entry to count as a hit
+        key = (seg_name, seq_hash(seq))
+        with self._lock:
+            row = self._connection().execute(f'SELECT {columns} FROM results WHERE segment = ? AND seq_hash = ?', key).fetchone()
+            if row is None or row[0] is None:
+                self.stats['cache_misses'] += 1
+                return None
+
+            self.stats['cache_hits'] += 1
+            self._used.append((time.time_ns(), *key))
+            return row
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is not None and self._pid == os.getpid():
+            return self._conn
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        self._pid = os.getpid()
+        self._conn.execute('PRAGMA journal_mode = WAL')
+        with self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS results (segment TEXT NOT NULL, seq_hash BLOB NOT NULL, version TEXT NOT NULL, '
+                'margin REAL, di_label TEXT, last_used INTEGER NOT NULL, PRIMARY KEY (segment, seq_hash))'
+            )
+            if 'margin' not in {col[1] for col in self._conn.execute('PRAGMA table_info(results)')}:
+                self._conn.execute('ALTER TABLE results ADD COLUMN margin REAL') # Databases created by older versions
+            self._conn.execute('CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)')
+
+            row = self._conn.execute("SELECT value FROM meta WHERE key = 'build_dates'").fetchone()
+            if row is None or row[0] != self.build_dates:
+                if row is not None:
+                    logging.info("Prediction models have changed, invalidating the result cache")
+                self._conn.execute('DELETE FROM results')
+                self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('build_dates', ?)", (self.build_dates,))
+        return self._conn
+
+
+def seq_hash(seq: str) -> bytes:
+    return hashlib.blake2b(seq.upper().encode(), digest_size=16).digest()
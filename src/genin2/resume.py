@@ -0,0 +1,107 @@
+'''
+Resumption of interrupted runs. The output of a run (and its calls file, if any) is written sample by sample, in the
+same order; when a run is resumed, the samples already written are skipped and the new ones are appended. Lines that
+were only partially written when the run was interrupted are discarded.
+'''
+import json, logging, os
+from typing import List, Optional, Set, Tuple
+from genin2.calls import CallsHeader, read_calls
+
+
+CHECKPOINT_INTERVAL = 30 # Seconds between the fsyncs of the output of resumable runs
+
+
+class ResumeError(Exception):
+    pass
+
+
+def resume_output(out_path: str, header: Optional[str], calls_path: Optional[str], calls_header: CallsHeader) -> Set[str]:
+    '''
+    Prepare the output of an interrupted run to be resumed, and return the names of the samples it already contains.
+
+    The output (and the calls file) are truncated after the last sample they both contain, so that they can be
+    appended to. Files that don't exist or are empty are left as they are, and the run starts from the beginning.
+
+    Args:
+        out_path (str): The output file
+        header (Optional[str]): The expected header line of the output, or None if the format has no header
+        calls_path (Optional[str]): The calls file, if the calls are saved. It must not be gzipped, as compressed files
+            cannot be truncated after the last complete sample.
+        calls_header (CallsHeader): The build dates of the installed models, that the calls file must match
+
+    Returns:
+        Set[str]: The names of the samples that are already in the output
+
+    Raises:
+        ResumeError: If a file doesn't match the options of the run
+    '''
+    out_names, out_ends = _read_output(out_path, header)
+    n_done = len(out_names)
+    if calls_path is not None:
+        calls_names, calls_ends = _read_calls(calls_path, calls_header)
+        n_done = min(n_done, len(calls_names))
+        if out_names[:n_done] != calls_names[:n_done]:
+            raise ResumeError(f"The samples in '{out_path}' and '{calls_path}' don't match")
+        _truncate(calls_path, calls_ends, n_done)
+    _truncate(out_path, out_ends, n_done)
+
+    logging.info("Resuming: %d samples are already in '%s'", n_done, out_path)
+    return set(out_names[:n_done])
+
+
+def _read_output(path: str, header: Optional[str]) -> Tuple[List[str], List[int]]:
+    # The name of each complete sample line, and the offset of the end of the line. The first offset is the end of
+    # the header, to which the file is truncated if no sample is kept.
+    names, ends = [], []
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return names, [0]
+
+    with open(path, 'rb') as f:
+        if header is not None:
+            line = f.readline()
+            if line.decode().rstrip('\n') != header:
+                raise ResumeError(f"'{path}' was not written by a run with the same output format")
+        ends.append(f.tell())
+        for line in iter(f.readline, b''):
+            if not line.endswith(b'\n'):
+                break # Partially written
+            names.append(_sample_name(line.decode(), header is None, path))
+            ends.append(f.tell())
+    return names, ends
+
+
+def _sample_name(line: str, jsonl: bool, path: str) -> str:
+    if not jsonl:
+        return line.split('\t', 1)[0]
+    try:
+        return json.loads(line)['Sample Name']
+    except (ValueError, KeyError, TypeError):
+        raise ResumeError(f"'{path}' was not written by a run with the same output format")
+
+
+def _read_calls(path: str, calls_header: CallsHeader) -> Tuple[List[str], List[int]]:
+    names, ends = [], []
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return names, [0]
+
+    with open(path, 'r') as f:
+        header, _ = read_calls(f)
+    if header != calls_header:
+        raise ResumeError(f"The calls in '{path}' were made with different models than the installed ones")
+
+    with open(path, 'rb') as f:
+        f.readline()
+        f.readline()
+        ends.append(f.tell())
+        for line in iter(f.readline, b''):
+            if not line.endswith(b'\n'):
+                break
+            names.append(line.decode().split('\t', 1)[0])
+            ends.append(f.tell())
+    return names, ends
+
+
+def _truncate(path: str, ends: List[int], n_lines: int) -> None:
+    if os.path.exists(path) and os.path.getsize(path) > ends[n_lines]:
+        with open(path, 'r+b') as f:
+            f.truncate(ends[n_lines])
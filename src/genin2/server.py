@@ -0,0 +1,320 @@
+import io, json, logging, os, queue, signal, socket, socketserver, stat, sys, threading, time
+import genin2.aligner as aligner
+import genin2.genin2_core as core
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, List, Optional, Tuple
+from urllib.parse import urlsplit, parse_qs
+
+
+MAX_REQUEST_BYTES = 256 * 1024 * 1024 # Larger request bodies are rejected
+LATENCY_WINDOW = 1000 # Number of recent measurements used to compute the latency percentiles
+
+
+class Job:
+    '''
+    The samples of a single request, waiting to be processed by the batcher. Samples are kept as an ordered list of
+    (name, segments) pairs, so that the results can be returned in the order of the request.
+    '''
+
+    def __init__(self, samples: List[Tuple[str, dict[str, str]]]):
+        self.samples = samples
+        self.enqueued = time.perf_counter()
+        self.done = threading.Event()
+        self.rows: Optional[List[List[Any]]] = None
+        self.error: Optional[Exception] = None
+
+
+class LatencyStats:
+    '''
+    Count and percentiles of the most recent measurements of a processing stage.
+    '''
+
+    def __init__(self):
+        self.count = 0
+        self.recent = deque(maxlen=LATENCY_WINDOW)
+
+    def add(self, seconds: float) -> None:
+        self.count += 1
+        self.recent.append(seconds)
+
+    def summary(self) -> dict[str, float]:
+        values = sorted(self.recent)
+        if not values:
+            return {'count': self.count}
+        percentile = lambda p: values[min(len(values) - 1, int(p * len(values)))] * 1000
+        return {
+            'count': self.count,
+            'mean_ms': sum(values) / len(values) * 1000,
+            'p50_ms': percentile(0.5),
+            'p95_ms': percentile(0.95),
+            'p99_ms': percentile(0.99),
+            'max_ms': values[-1] * 1000,
+        }
+
+
+class MicroBatcher:
+    '''
+    Collects the jobs submitted by the request handlers and processes them in a single background thread. Jobs that
+    arrive within `window` seconds of each other are merged into one batch (of at most `max_samples` samples, unless a
+    single job is larger), so that the segments of concurrent requests are classified with shared model calls.
+    '''
+
+    def __init__(self, window: float, max_samples: int):
+        self.window = window
+        self.max_samples = max_samples
+        self.jobs: queue.Queue[Optional[Job]] = queue.Queue()
+        self.lock = threading.Lock()
+        self.counters = Counter()
+        self.batch_sizes = Counter()
+        self.latency = {stage: LatencyStats() for stage in ('parse', 'queue', 'predict', 'total')}
+        self.started = time.time()
+        self._thread = threading.Thread(target=self._loop, name='genin2-batcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, samples: List[Tuple[str, dict[str, str]]]) -> List[List[Any]]:
+        '''
+        Queue a list of samples and wait for their rows of output (see `genin2_core.prediction_to_row()`).
+
+        Raises:
+            Exception: Any error raised while processing the batch that contained the samples
+        '''
+        job = Job(samples)
+        self.jobs.put(job)
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.rows
+
+    def record(self, stage: str, seconds: float) -> None:
+        with self.lock:
+            self.latency[stage].add(seconds)
+
+    def stop(self) -> None:
+        self.jobs.put(None)
+        self._thread.join()
+
+    def metrics(self) -> dict:
+        with self.lock:
+            n_batches = self.counters['batches']
+            return {
+                'uptime_s': time.time() - self.started,
+                'queue_depth': self.jobs.qsize(),
+                'requests': self.counters['requests'],
+                'failed_requests': self.counters['failed_requests'],
+                'samples': self.counters['samples'],
+                'batches': n_batches,
+                'mean_batch_size': self.counters['samples'] / n_batches if n_batches else 0,
+                'batch_sizes': {str(size): count for size, count in sorted(self.batch_sizes.items())},
+                'result_cache': {k: self.counters[k] for k in ('cache_hits', 'cache_misses')} if core.result_cache is not None else None,
+                'alignment': aligner.summarize_stats(self.counters),
+                'latency': {stage: stats.summary() for stage, stats in self.latency.items()},
+            }
+
+    def _next_batch(self) -> Optional[List[Job]]:
+        job = self.jobs.get()
+        if job is None:
+            return None
+
+        batch, n_samples = [job], len(job.samples)
+        deadline = time.perf_counter() + self.window
+        while n_samples < self.max_samples:
+            try:
+                job = self.jobs.get(timeout=max(0, deadline - time.perf_counter()))
+            except queue.Empty:
+                break
+            if job is None:
+                self.jobs.put(None) # Stop after this batch
+                break
+            batch.append(job)
+            n_samples += len(job.samples)
+        return batch
+
+    def _loop(self) -> None:
+        while (batch := self._next_batch()) is not None:
+            samples = [sample for job in batch for sample in job.samples]
+            start = time.perf_counter()
+            for job in batch:
+                self.record('queue', start - job.enqueued)
+
+            try:
+                predictions, stats = core.process_chunk(samples)
+                rows = [core.prediction_to_row(pred) for pred in predictions]
+            except Exception as e:
+                logging.error("Couldn't process a batch of %d samples (%s, %s)", len(samples), type(e).__name__, str(e))
+                for job in batch:
+                    job.error = e
+                    job.done.set()
+                continue
+
+            self.record('predict', time.perf_counter() - start)
+            with self.lock:
+                self.counters.update(stats)
+                self.counters['batches'] += 1
+                self.counters['samples'] += len(samples)
+                self.batch_sizes[len(samples)] += 1
+
+            offset = 0
+            for job in batch:
+                job.rows = rows[offset:offset + len(job.samples)]
+                offset += len(job.samples)
+                job.done.set()
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    '''
+    Endpoints:
+        POST /predict: FASTA input, returns TSV, or JSON with `?format=json` or `Accept: application/json`. The extended
+            output formats of the command line tool are available with `?format=tsv-extended` and `?format=jsonl`.
+        GET /health: status and model build dates
+        GET /metrics: queue depth, batch sizes and latency of each stage
+    '''
+
+    server_version = f'genin2/{core.__version__}'
+    batcher: MicroBatcher # Set by serve()
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path == '/health':
+            self._send_json(200, {
+                'status': 'ok',
+                'version': core.__version__,
+                'models_build_date': str(core.models['build_date']),
+                'di_models_build_date': str(core.di_discr.model_build_date),
+            })
+        elif path == '/metrics':
+            self._send_json(200, self.batcher.metrics())
+        else:
+            self._send_error(404, f"Unknown endpoint '{path}'")
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path != '/predict':
+            self._send_error(404, f"Unknown endpoint '{url.path}'")
+            return
+
+        start = time.perf_counter()
+        try:
+            length = int(self.headers.get('Content-Length', ''))
+        except ValueError:
+            self._send_error(411, "A Content-Length header is required")
+            return
+        if length > MAX_REQUEST_BYTES:
+            self._send_error(413, f"Request bodies are limited to {MAX_REQUEST_BYTES} bytes")
+            return
+
+        try:
+            body = self.rfile.read(length).decode()
+            samples = list(core.preload_samples(io.StringIO(body)).items())
+        except Exception as e:
+            self._send_error(400, f"Couldn't parse the FASTA input ({type(e).__name__}, {e})")
+            return
+        self.batcher.record('parse', time.perf_counter() - start)
+
+        with self.batcher.lock:
+            self.batcher.counters['requests'] += 1
+        try:
+            rows = self.batcher.submit(samples) if samples else []
+        except Exception as e:
+            with self.batcher.lock:
+                self.batcher.counters['failed_requests'] += 1
+            self._send_error(500, f"Couldn't complete the analysis ({type(e).__name__}, {e})")
+            return
+
+        output_format = parse_qs(url.query).get('format', [''])[0]
+        if output_format == 'json' or (not output_format and 'application/json' in self.headers.get('Accept', '')):
+            self._send_json(200, [dict(zip(core.output_columns, row)) for row in rows])
+        elif output_format == 'jsonl':
+            body = ''.join(core.format_row(row, 'jsonl') for row in rows)
+            self._send(200, 'application/x-ndjson', body.encode())
+        else:
+            output_format = 'tsv-extended' if output_format == 'tsv-extended' else 'tsv'
+            header = '\t'.join(core.extended_columns if output_format == 'tsv-extended' else core.output_columns) + '\n'
+            body = header + ''.join(core.format_row(row, output_format) for row in rows)
+            self._send(200, 'text/tab-separated-values; charset=utf-8', body.encode())
+        self.batcher.record('total', time.perf_counter() - start)
+
+    def _send(self, status: int, content_type: str, body: bytes) -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status: int, obj) -> None:
+        self._send(status, 'application/json', json.dumps(obj).encode())
+
+    def _send_error(self, status: int, msg: str) -> None:
+        self._send_json(status, {'error': msg})
+
+    def address_string(self) -> str:
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix-socket'
+
+    def log_message(self, format, *args) -> None:
+        logging.debug("%s - %s", self.address_string(), format % args)
+
+
+class PredictionServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128 # Listen backlog, large enough for bursts of concurrent clients
+
+
+class UnixPredictionServer(PredictionServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        socketserver.TCPServer.server_bind(self)
+        self.server_name, self.server_port = 'localhost', 0
+
+
+def serve(host: str, port: int, unix_socket: Optional[str], batch_window: float, **kwargs) -> None:
+    '''
+    Load the models once and serve predictions over HTTP, on a TCP port or on a Unix socket, until interrupted.
+
+    Args:
+        host (str): The address to listen on
+        port (int): The TCP port to listen on
+        unix_socket (Optional[str]): If given, listen on this Unix socket instead of the TCP port
+        batch_window (float): How long to wait for other requests before processing a batch, in milliseconds
+        kwargs: The analysis options, as for `run()`
+    '''
+    core.init_logging(kwargs['loglevel'])
+    if unix_socket is not None and os.path.lexists(unix_socket) and not is_socket(unix_socket):
+        core.critical_error(f"Couldn't start the server: '{unix_socket}' exists and is not a socket")
+    logging.info("Initializing")
+    core.init_data()
+    core.apply_settings(**kwargs)
+    core.di_discr.dd_models # Load the DI models upfront, so that the first DI sample is not slower than the others
+
+    batcher = RequestHandler.batcher = MicroBatcher(batch_window / 1000, core.BATCH_SIZE)
+    try:
+        if unix_socket is not None:
+            if is_socket(unix_socket):
+                os.unlink(unix_socket) # Left behind by a previous server
+            server = UnixPredictionServer(unix_socket, RequestHandler)
+            address = unix_socket
+        else:
+            server = PredictionServer((host, port), RequestHandler)
+            address = f'http://{host}:{server.server_port}'
+    except OSError as e:
+        core.critical_error("Couldn't start the server", e)
+
+    # Stop gracefully on SIGTERM as well as on Ctrl+C
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    print(f"Genin2 {core.__version__} is listening on {address}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        logging.info("Shutting down")
+    finally:
+        server.server_close()
+        batcher.stop()
+        if unix_socket is not None and is_socket(unix_socket):
+            os.unlink(unix_socket)
+
+
+def is_socket(path: str) -> bool:
+    try:
+        return stat.S_ISSOCK(os.lstat(path).st_mode)
+    except OSError:
+        return False
@@ -1,6 +1,14 @@
-from Bio.Align import PairwiseAligner
-import itertools
-from typing import List
+from pathlib import Path
+import itertools, os, queue, sys, threading, zlib
+import numpy as np
+from typing import Iterable, Iterator, List, Optional, Tuple, TypeVar, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from Bio.Align import PairwiseAligner
+
+
+T = TypeVar('T')
+EncodedSample = dict[str, np.ndarray] # The aligned and encoded sequence of each segment of a sample
 
 
 
@@ -21,43 +29,182 @@ alignment_refs['PB1'] = 'ATGGATGTCAATCCGACTTTACTTTTCTTAAAAGTGCCAGCGCAAGATGCCATAA
 alignment_refs['PB2'] = 'ATGGAGAGAATAAAAGAGCTAAGAGATTTGATGTCGCAGTCTCGCACTCGCGAGATACTGACAAAAACCACCGTGGACCATATGGCCATAATCAAGAAATATACATCAGGAAGACAGGAGAAGAACCCTGCACTTAGGATGAAGTGGATGATGGCAATGAAATATCCGATTACAGCAGACAAAAGGATAATGGAGATGATCCCTGAAAGAAACGAGCAAGGTCAGACTCTTTGGAGCAAAACAAATGATGCTGGATCGGATAGAGTAATGGTGTCACCTCTGGCTGTGACGTGGTGGAATAGAAATGGACCAACAACAAGTACAGTCCATTACCCAAAGGTCTATAAAACTTACTTTGAAAAGGTTGAAAGGTTAAAGCATGGAACCTTCGGCCCTGTCCATTTCCGGAATCAGGTTAAGATACGCCGCAGAGTTGACATAAACCCGGGCCATGCAGACCTCAGTGCTAAAGAAGCACAAGACGTCATCATGGAGGTCGTTTTCCCAAATGAAGTCGGAGCCAGAATATTGACATCAGAGTCACAGTTAACAATTACAAAAGAAAAGAAGGAGGAACTCCAGGACTGTAAGATTGCCCCTCTAATGGTGGCATACATGTTGGAGAGAGAACTGGTTCGAAAAACCAGATTCCTGCCAGTAGCTGGCGGAACAAGTAGCGTATATATCGAAGTGTTGCACCTGACTCAAGGAACCTGCTGGGAACAAATGTATACGCCAGGAGGAGAAGTGAGAAATGATGACATTGACCAAAGTTTAATTATTGCTGCCAGAAATATCGTTAGGAGAGCAACAGTATCAGCAGACCCATTGGCTTCACTACTGGAGATGTGCCATAGTACACAGATTGGCGGGATAAGAATGGTAGACATTCTTAGACAGAACCCAACAGAAGAGCAAGCCGTGGATATATGCAAAGCAGCAATGGGTTTAAGAATCAGTTCATCCTTCAGTTTTGGAGGTTTCACTTTCAAAAGGACAAGCGGATCATCTGTCAAAAGAGAAGAGGAAGTGCTCACCGGCAACCTCCAAACATTGAAAATAAGAGTACATGAAGGGTATGAGGAATTCACAATGGTTGGGCGGAGAGCAACAGCCATTCTAAGGAAAGCAACCAGAAGGCTGATCCAATTGATAGTAAGTGGAAAAGACGAGCAGTCAATCGCCGAAGCGATCATAGTGGCAATGGTGTTCTCTCAAGAGGATTGCATGATAAAGGCTGTACGAGGTGATTTAAATTTTGTCAATAGAGCGAATCAGCGGCTCAATCCTATGCATCAGCTCCTGAGGCATTTCCAAAAGGATGCAAAGGTACTATTCCAAAACTGGGGAATTGAACCCATTGACAATGTCATGGGAATGATAGGAATATTGCCTGATATGACTCCCAGCACAGAGATGTCACTAAGAGGAGTGAGGGTCAGTAAAATGGGAGTGGATGAATATTCCAGTACTGAGAGGGTGGTCGTGAGTATTGATCGCTTCTTGAGGGTACGAGACCAGAGAGGAAATGTACTCTTGTCTCCCGAAGAGGTCAGTGAAACACAGGGAACAGAGAAGCTAACGATAACATATTCATCATCCATGATGTGGGAAATTAATGGCCCTGAGTCAGTGCTAGTTAACACATATCAATGGGTCATCAGAAACTGGGAAACTGTGAAGATTCAGTGGTCCCAAGACCCTACAATGCTATACAACAAGATGGAGTTTGAGCCTTTTCAGTCCTTGGTGCCCAAGGCAGCCAGAGGCCAGTACAGTGGATTTGTAAGGACCTTATTCCAGCAGATGCGTGATGTGCTGGGAACCTTTGACACTGTCCAGATAATAAAGCTACTTCCATTTGCAGCAGCACCACCGGAACAGAGTAGGATGCAGTTCTCTTCTCTAACTGTAAACGTAAGGGGTTCAGGAATGAGAATACTTGTGAGAGGAAACTCCCCTGTGTTCAACTATAATAAGGCAACCAAGAGGCTCATAGTCCTTGGAAAGGATGCTGGTGCATTGACAGGAGACCCAGGTGAGGGGACAGCAGGAGTGGAGTCTGCGGTATTGAGAGGGTTCCTAATTCTGGGCAAAGAGGACAAAAGATATGGACCAGCGCTGAGCATCAATGAATTGAGCAATCTTGCGAAAGGGGAGAAGGCTAATGTGTTGATAGGGCAAGGAGACGTGGTGTTGGTGATGAAACGGAAACGGGACTCTAGCATACTTACTGACAGCCAGACAGCGACCAAAAGAATTCGGATGGCCATCAATTA'
 
 
-def read_fasta(file):
-    sample_name = None
-    seq = []
-    
-    for line in file:
-        if not (line := line.strip()):
-            continue
+FASTA_BUFFER_SIZE = 1 << 22
+
+
+def read_fasta(file, buffer_size: int = FASTA_BUFFER_SIZE) -> Iterator[Tuple[str, str]]:
+    '''
+    Parse a FASTA file, reading it in large buffers that are split into records at each header, instead of line by
+    line. Anything before the first header is ignored.
+
+    Args:
+        file: A text or binary (UTF-8) file handle
+        buffer_size (int): The maximum size of the reads
+
+    Returns:
+        Iterator[Tuple[str, str]]: The (header, sequence) pairs, without the leading '>' and with uppercase sequences
+    '''
+    for records in read_fasta_chunks(file, buffer_size):
+        yield from records
+
+
+def read_fasta_chunks(file, buffer_size: int = FASTA_BUFFER_SIZE) -> Iterator[List[Tuple[str, str]]]:
+    '''
+    Parse a FASTA file like `read_fasta()`, yielding together the records completed by each read. Binary files are
+    read with `read1()`, which returns the data already available instead of waiting for a whole buffer: on pipes,
+    each record is yielded as soon as the next header (or the end of the input) arrives.
+
+    Args:
+        file: A text or binary (UTF-8) file handle
+        buffer_size (int): The maximum size of the reads
 
-        if line.startswith('>'):
-            if sample_name is not None:
-                yield sample_name, ''.join(seq).upper()
-            sample_name = line[1:]
-            seq.clear()
-        else:
-            seq.append(line)
-    
-    if sample_name is not None:
-        yield sample_name, ''.join(seq).upper()
+    Returns:
+        Iterator[List[Tuple[str, str]]]: The (header, sequence) pairs completed by each read
+    '''
+    read = getattr(file, 'read1', file.read)
+    buffer = read(buffer_size)
+    if not buffer:
+        return
+    binary = isinstance(buffer, bytes)
+    sep = b'\n>' if binary else '\n>'
+    buffer = sep[:1] + buffer # So that a header at the start of the file is found as well
+
+    while True:
+        # Only the records followed by another header are complete, until the end of the file is reached. Complete
+        # records end with a newline, so they can be decoded without splitting multi-byte characters.
+        end = buffer.rfind(sep)
+        if end > 0:
+            yield _parse_records(buffer[:end].decode() if binary else buffer[:end])
+            buffer = buffer[end:]
+        data = read(buffer_size)
+        if not data:
+            yield _parse_records(buffer.decode() if binary else buffer)
+            return
+        buffer += data
+
+
+def _parse_records(records: str) -> List[Tuple[str, str]]:
+    parsed = []
+    for record in records.split('\n>')[1:]:
+        header, _, seq = record.partition('\n')
+        seq = seq.replace('\n', '')
+        if '\r' in seq or ' ' in seq or '\t' in seq:
+            seq = ''.join(seq.split())
+        parsed.append((header.rstrip(), seq.upper()))
+    return parsed
+
+
+_aligner: Optional['PairwiseAligner'] = None
 
 
 def pairwise_alignment(ref_seq, q_seq):
-    aligner = PairwiseAligner()
-    aligner.match_score = 1
-    aligner.mismatch_score = -1
-    aligner.open_gap_score = -4
-    aligner.extend_gap_score = -1
-    ref_al, q_al = aligner.align(ref_seq, q_seq)[0]
+    global _aligner
+    if _aligner is None:
+        from Bio.Align import PairwiseAligner
+        _aligner = PairwiseAligner()
+        _aligner.match_score = 1
+        _aligner.mismatch_score = -1
+        _aligner.open_gap_score = -4
+        _aligner.extend_gap_score = -1
+    ref_al, q_al = _aligner.align(ref_seq, q_seq)[0]
     cut_al = cut_alignment(ref_al, q_al)
     return cut_al
 
 
 def cut_alignment(ref, qry):
-    gap_idxs = [i for i, nt in enumerate(ref) if nt == '-']
-    return ''.join(nt for i, nt in enumerate(qry) if i not in gap_idxs)
+    return ''.join(nt for ref_nt, nt in zip(ref, qry) if ref_nt != '-')
+
+
+def chunked(items: Iterable[T], size: int) -> Iterator[List[T]]:
+    it = iter(items)
+    while (chunk := list(itertools.islice(it, size))):
+        yield chunk
+
+
+def chunked_available(items: Iterable[T], size: int, timeout: Optional[float] = None) -> Iterator[List[T]]:
+    '''
+    Split items into chunks of at most `size` like `chunked()`, but yield each chunk as soon as no further item is
+    ready, instead of waiting for it to be full. The items are produced in a background thread, so that the consumer
+    can tell whether the next one is ready, and stays at most `size` items ahead of the consumer.
 
+    Args:
+        items (Iterable[T]): The items. Exceptions raised while producing them are re-raised by the returned iterator.
+        size (int): The maximum number of items in a chunk
+        timeout (Optional[float]): If given, an empty chunk is yielded whenever no item is produced within `timeout`
+            seconds, so that the consumer can do other work while waiting
 
-def encode_sequence(seq: str) -> List[bool]:
+    Returns:
+        Iterator[List[T]]: The chunks of items
+    '''
+    ready: queue.Queue = queue.Queue(size)
+    stop = threading.Event()
+
+    def put(entry) -> bool:
+        while not stop.is_set():
+            try:
+                ready.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def producer() -> None:
+        try:
+            for item in items:
+                if not put(('item', item)):
+                    return
+            put(('end', None))
+        except Exception as e:
+            put(('error', e))
+
+    thread = threading.Thread(target=producer, name='genin2-chunker', daemon=True)
+    thread.start()
+    try:
+        while True:
+            try:
+                kind, value = ready.get(timeout=timeout)
+            except queue.Empty:
+                yield []
+                continue
+            chunk = []
+            while kind == 'item':
+                chunk.append(value)
+                if len(chunk) == size:
+                    break
+                try:
+                    kind, value = ready.get_nowait()
+                except queue.Empty:
+                    break
+            if chunk:
+                yield chunk
+            if kind == 'error':
+                raise value
+            if kind == 'end':
+                return
+    finally:
+        stop.set()
+
+
+def in_shard(sample_name: str, index: int, count: int) -> bool:
+    '''
+    Whether a sample belongs to the shard `index` (1-based) of `count`. Samples are assigned to shards by the hash of
+    their name, which doesn't depend on the position of the sample in the input nor on the Python process, so that the
+    shards of a file are disjoint and cover all of its samples.
+    '''
+    return zlib.crc32(sample_name.encode()) % count == index - 1
+
+
+def user_cache_dir() -> Path:
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA') or Path.home().joinpath('AppData', 'Local')
+    elif sys.platform == 'darwin':
+        base = Path.home().joinpath('Library', 'Caches')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or Path.home().joinpath('.cache')
+    return Path(base).joinpath('genin2')
+
+
+def _build_encoding_table() -> np.ndarray:
     T, F = True, False
     encoding_dict = {
         'A': [T, F, F, F], 'C': [F, T, F, F], 'G': [F, F, T, F], 'T': [F, F, F, T], 'U': [F, F, F, T], 'W': [T, F, F, T],
@@ -65,10 +212,46 @@ def encode_sequence(seq: str) -> List[bool]:
         'D': [T, F, T, T], 'H': [T, T, F, T], 'V': [T, T, T, F], 'N': [T, T, T, T], 'Z': [F, F, F, F], '-': [F, F, F, F]
     }
 
+    table = np.zeros((256, 4), dtype=bool)
+    for base, encoding in encoding_dict.items():
+        table[ord(base)] = encoding
+    return table
+
+
+_encoding_table = _build_encoding_table() # Maps each byte value to the 4 one-hot values of the corresponding nucleotide
+_valid_codes = np.zeros(256, dtype=bool) # Marks the byte values of the nucleotides in `_encoding_table`
+_valid_codes[[ord(base) for base in 'ACGTUWSMKRYBDHVNZ-']] = True
+
+
+def encode_sequence(seq: str, out: Optional[np.ndarray] = None) -> np.ndarray:
+    '''
+    One-hot encode an aligned sequence, with 4 boolean values for each nucleotide. IUPAC degenerations set all the
+    values of the nucleotides they represent.
+
+    Args:
+        seq (str): The aligned sequence
+        out (Optional[np.ndarray]): A boolean array of length `4 * len(seq)` to write the encoding to, e.g. a row of a
+            preallocated matrix. If None, a new array is allocated.
+
+    Returns:
+        np.ndarray: The encoded sequence
+
+    Raises:
+        InvalidEncoding: If the sequence contains a character that is not a valid nucleotide
+    '''
     try:
-        return list(itertools.chain(*[encoding_dict[base] for base in seq]))
-    except KeyError as ex:
-        raise InvalidEncoding(f"Invalid nucleotide found: '{ex.args[0]}' is an unknown IUPAC degeneration")
+        codes = np.frombuffer(seq.encode('ascii'), dtype=np.uint8)
+    except UnicodeEncodeError as ex:
+        raise InvalidEncoding(f"Invalid nucleotide found: '{ex.object[ex.start]}' is an unknown IUPAC degeneration")
+
+    valid = _valid_codes[codes]
+    if not valid.all():
+        raise InvalidEncoding(f"Invalid nucleotide found: '{chr(codes[np.argmin(valid)])}' is an unknown IUPAC degeneration")
+
+    if out is None:
+        out = np.empty(4 * len(codes), dtype=bool)
+    np.take(_encoding_table, codes, axis=0, out=out.reshape(len(codes), 4))
+    return out
 
 
 class InvalidEncoding(Exception):
@@ -0,0 +1,25 @@
+'''
+Regression tests of the anchored alignment: the projection of each sequence of the corpus must be the same as the one
+obtained from a global alignment of the whole sequence. The corpus contains mutated references with substitutions,
+short indels, runs of Ns and truncated ends, as well as duplications and long insertions and deletions, which could
+mislead the anchoring.
+'''
+import lzma
+from pathlib import Path
+import pytest
+from genin2.aligner import project_to_reference
+from genin2.utils import alignment_refs, pairwise_alignment, read_fasta
+
+
+CORPUS = Path(__file__).parent / 'data' / 'alignment_corpus.fa.xz'
+
+
+def read_corpus():
+    with lzma.open(CORPUS, 'rt') as f:
+        return [pytest.param(header, seq, id=header) for header, seq in read_fasta(f)]
+
+
+@pytest.mark.parametrize('header, seq', read_corpus())
+def test_projection_matches_global_alignment(header, seq):
+    seg_name = header.rsplit('_', 1)[1]
+    assert project_to_reference(seg_name, seq) == pairwise_alignment(alignment_refs[seg_name], seq)
@@ -0,0 +1,94 @@
+'''
+Tests of the calls files and of the assignment of genotypes from saved calls: assigning the genotypes again with the
+same compositions must reproduce the output of the analysis, and `CompositionIndex` must find the same compatible
+genotypes as a filter of the compositions table.
+'''
+import io, lzma, random
+from pathlib import Path
+from genin2.calls import CallsHeader, prediction_to_calls, read_calls, reassign_sample, write_header
+from genin2.di_discriminator import vote_subgenotype
+from genin2.genin2_core import format_row, prediction_to_row
+from genin2.predictor import CompositionIndex, Genin2Predictor, SamplePrediction, SegmentPrediction, load_compositions
+from genin2.utils import alignment_refs, read_fasta
+
+
+CORPUS = Path(__file__).parent / 'data' / 'alignment_corpus.fa.xz'
+CALLS_HEADER = CallsHeader('2026-01-01', '2025-01-01')
+
+
+def filter_compositions(genotype2versions, versions):
+    # The compatible genotypes as computed before `CompositionIndex`
+    gset = genotype2versions
+    for s, v in versions.items():
+        if v != '?':
+            gset = {gen: comp for gen, comp in gset.items() if comp[s] == v}
+    return list(gset.keys())
+
+
+def round_trip(predictions, compositions):
+    file = io.StringIO()
+    write_header(file, CALLS_HEADER)
+    file.writelines(prediction_to_calls(pred) for pred in predictions)
+    file.seek(0)
+    header, saved_calls = read_calls(file)
+    assert header == CALLS_HEADER
+    return [reassign_sample(saved, compositions)[0] for saved in saved_calls]
+
+
+def assert_same_output(predictions, reassigned):
+    for output_format in ('tsv', 'tsv-extended', 'jsonl'):
+        expected = [format_row(prediction_to_row(pred), output_format) for pred in predictions]
+        assert [format_row(prediction_to_row(pred), output_format) for pred in reassigned] == expected
+
+
+def test_composition_index_matches_filter():
+    genotype2versions = load_compositions()
+    index = CompositionIndex(genotype2versions)
+    seg_versions = {seg_name: sorted({comp[seg_name] for comp in genotype2versions.values()}) + ['?', 'x'] for seg_name in alignment_refs}
+    rng = random.Random(0)
+
+    cases = [dict(comp) for comp in genotype2versions.values()]
+    for comp in genotype2versions.values():
+        cases.append({seg_name: version if rng.random() < 0.5 else '?' for seg_name, version in comp.items()})
+    cases.extend({seg_name: rng.choice(versions) for seg_name, versions in seg_versions.items()} for _ in range(1000))
+    for versions in cases:
+        assert index.get_compatible_genotypes(versions) == filter_compositions(genotype2versions, versions)
+
+
+def test_reassign_reproduces_compositions():
+    # A sample for each genotype, with the DI votes of the EA-2024-DI ones, and samples with partial or unknown calls
+    genotype2versions = load_compositions()
+    compositions = CompositionIndex(genotype2versions)
+    rng = random.Random(1)
+    predictions = []
+    for i, comp in enumerate(list(genotype2versions.values()) + [{seg_name: '?' for seg_name in alignment_refs}]):
+        segments = {
+            seg_name: SegmentPrediction(version, '' if version != '?' else 'unassigned', rng.uniform(-0.5, 3) if version != '?' else None)
+            for seg_name, version in comp.items()
+        }
+        if i % 3 == 0:
+            segments['PA'] = SegmentPrediction('?', 'missing', None)
+        genotype = compositions.assign_genotype(segments)
+        subgenotype = None
+        if genotype.GenotypeName == 'EA-2024-DI':
+            subgenotype = vote_subgenotype({seg_name: rng.choice(['DI', 'DI.1', 'DI.2']) for seg_name in alignment_refs})
+        predictions.append(SamplePrediction(f'sample{i}', genotype, subgenotype, segments))
+
+    assert any(pred.Subgenotype is not None for pred in predictions)
+    assert_same_output(predictions, round_trip(predictions, compositions))
+
+
+def test_reassign_reproduces_predictions():
+    with lzma.open(CORPUS, 'rt') as f:
+        records = list(read_fasta(f))
+    # Samples made of consecutive records of the corpus, some of which lack a segment
+    samples = []
+    for start in range(0, len(records) - len(alignment_refs), len(alignment_refs)):
+        sample = {header.rsplit('_', 1)[1]: seq for header, seq in records[start:start + len(alignment_refs)]}
+        if len(samples) % 4 == 0:
+            sample.pop('NP', None)
+        samples.append((f'sample{len(samples)}', sample))
+
+    predictor = Genin2Predictor()
+    predictions = list(predictor.predict_many(samples))
+    assert_same_output(predictions, round_trip(predictions, predictor.compositions))
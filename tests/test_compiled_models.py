@@ -0,0 +1,43 @@
+'''
+The compiled models must give the same predictions as the scikit-learn estimators they are compiled from, and the same
+scores up to rounding. They are checked at run time on a validation corpus with a fixed seed; here, they are compared
+on other mutated corpora, on random rows that are not one-hot encoded, and on rows that are not binary.
+'''
+import importlib_resources
+import joblib
+import numpy as np
+import pytest
+from genin2.compiled_models import CompiledForest, CompiledSVC, compile_model, validation_corpus
+from genin2.utils import alignment_refs
+
+
+@pytest.fixture(scope='module')
+def estimators():
+    package_files = importlib_resources.files('genin2')
+    return {file_name: joblib.load(package_files.joinpath(file_name)) for file_name in ('models.xz', 'dd.xz')}
+
+
+def mutated_corpus(svc, seed):
+    rng = np.random.default_rng(seed)
+    support_vectors = np.asarray(svc.support_vectors_)
+    random_bits = rng.random((20, support_vectors.shape[1])) < 0.3
+    return np.vstack([validation_corpus(support_vectors, seed=seed), random_bits])
+
+
+@pytest.mark.parametrize('seg_name', alignment_refs.keys())
+@pytest.mark.parametrize('file_name, model_class, scores', [
+    ('models.xz', CompiledSVC, 'decision_function'),
+    ('dd.xz', CompiledForest, 'predict_proba'),
+])
+def test_compiled_model_matches_estimator(estimators, file_name, model_class, scores, seg_name):
+    estimator = estimators[file_name][seg_name]
+    compiled = compile_model(estimator, (file_name, seg_name))
+    assert isinstance(compiled, model_class)
+
+    X = mutated_corpus(estimators['models.xz'][seg_name], seed=7)
+    assert np.array_equal(compiled.predict(X), estimator.predict(X))
+    np.testing.assert_allclose(getattr(compiled, scores)(X), getattr(estimator, scores)(X), rtol=1e-9, atol=1e-12)
+
+    # Rows that are not binary are classified by the estimator itself
+    X_float = X[:5] * 0.5
+    assert np.array_equal(compiled.predict(X_float), estimator.predict(X_float))
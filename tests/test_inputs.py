@@ -0,0 +1,36 @@
+'''
+Tests of the FASTA parser and of the background reader of the input files.
+'''
+import io, os, threading
+import pytest
+from genin2.inputs import read_inputs
+from genin2.utils import read_fasta
+
+
+FASTA = 'ignored\n>s1_PB2 \nacgt\nNNAC\n\n>s1_NS\r\nAC GT\r\n>s2_MP\n>s3_NA\nTTTT'
+RECORDS = [('s1_PB2', 'ACGTNNAC'), ('s1_NS', 'ACGT'), ('s2_MP', ''), ('s3_NA', 'TTTT')]
+
+
+@pytest.mark.parametrize('buffer_size', [1, 2, 3, 5, 8, 1 << 22])
+@pytest.mark.parametrize('binary', [False, True], ids=['text', 'binary'])
+def test_read_fasta_buffer_boundaries(buffer_size, binary):
+    file = io.BufferedReader(io.BytesIO(FASTA.encode())) if binary else io.StringIO(FASTA)
+    assert list(read_fasta(file, buffer_size)) == RECORDS
+
+
+def test_read_inputs_from_pipe_before_eof(monkeypatch):
+    # The records are available as soon as the next header arrives, while the pipe is still open. The pipe is closed
+    # after a while anyway, so that the test fails instead of hanging if the reader waits for the end of the input.
+    read_fd, write_fd = os.pipe()
+    monkeypatch.setattr('sys.stdin', io.TextIOWrapper(open(read_fd, 'rb')))
+    os.write(write_fd, b'>s1_NS\nACGT\n>s2_NS\nAC')
+    closer = threading.Timer(5, os.close, (write_fd,))
+    closer.start()
+    records = read_inputs(['-'])
+    first = next(records)
+    assert closer.is_alive()
+    closer.cancel()
+    os.write(write_fd, b'GT\n')
+    os.close(write_fd)
+    assert first == ('s1_NS', 'ACGT')
+    assert list(records) == [('s2_NS', 'ACGT')]
@@ -0,0 +1,18 @@
+'''
+The build dates listed in `build_dates.json` must match the model files shipped with the package, as they are used to
+invalidate the result cache and to validate calls files without loading the models.
+'''
+import hashlib, json
+import importlib_resources
+import joblib
+import pytest
+from genin2.model_cache import BUILD_DATES_FILE
+
+
+@pytest.mark.parametrize('file_name', ['models.xz', 'dd.xz'])
+def test_build_dates_match_models(file_name):
+    package_files = importlib_resources.files('genin2')
+    entry = json.loads(package_files.joinpath(BUILD_DATES_FILE).read_text())[file_name]
+    data_file = package_files.joinpath(file_name)
+    assert entry['blake2b'] == hashlib.blake2b(data_file.read_bytes(), digest_size=8).hexdigest()
+    assert entry['build_date'] == str(joblib.load(data_file)['build_date'])
@@ -0,0 +1,80 @@
+'''
+Tests of the resumption of interrupted runs: the output and the calls file are truncated after the last sample that
+both contain completely, and the names of those samples are returned.
+'''
+import pytest
+from genin2.calls import CallsHeader, CALLS_MAGIC, CALLS_VERSION, calls_columns
+from genin2.resume import ResumeError, resume_output
+
+
+HEADER = 'Sample Name\tGenotype'
+CALLS_HEADER = CallsHeader('2026-01-01', '2025-01-01')
+
+
+def calls_line(name):
+    return '\t'.join([name] + ['1'] * (len(calls_columns) - 1)) + '\n'
+
+
+def write_calls(path, names, partial=''):
+    header = f'{CALLS_MAGIC}\tversion={CALLS_VERSION}\tmodels={CALLS_HEADER.ModelsBuildDate}\tdi_models={CALLS_HEADER.DIModelsBuildDate}\n'
+    path.write_text(header + '\t'.join(calls_columns) + '\n' + ''.join(calls_line(name) for name in names) + partial)
+
+
+def test_missing_output_starts_from_scratch(tmp_path):
+    out_path = tmp_path / 'out.tsv'
+    assert resume_output(str(out_path), HEADER, None, CALLS_HEADER) == set()
+    assert not out_path.exists()
+
+
+def test_partial_last_line_is_discarded(tmp_path):
+    out_path = tmp_path / 'out.tsv'
+    out_path.write_text(f'{HEADER}\ns1\tA\ns2\tB\ns3\tC')
+    assert resume_output(str(out_path), HEADER, None, CALLS_HEADER) == {'s1', 's2'}
+    assert out_path.read_text() == f'{HEADER}\ns1\tA\ns2\tB\n'
+
+
+def test_header_only_is_kept(tmp_path):
+    out_path = tmp_path / 'out.tsv'
+    out_path.write_text(f'{HEADER}\ns1\tA')
+    assert resume_output(str(out_path), HEADER, None, CALLS_HEADER) == set()
+    assert out_path.read_text() == f'{HEADER}\n'
+
+
+def test_jsonl_output(tmp_path):
+    out_path = tmp_path / 'out.jsonl'
+    out_path.write_text('{"Sample Name": "s1"}\n{"Sample Name": "s2"}\n{"Sample')
+    assert resume_output(str(out_path), None, None, CALLS_HEADER) == {'s1', 's2'}
+    assert out_path.read_text() == '{"Sample Name": "s1"}\n{"Sample Name": "s2"}\n'
+
+
+def test_output_and_calls_truncated_to_common_samples(tmp_path):
+    out_path, calls_path = tmp_path / 'out.tsv', tmp_path / 'out.calls'
+    out_path.write_text(f'{HEADER}\ns1\tA\ns2\tB\ns3\tC\n')
+    write_calls(calls_path, ['s1', 's2'], partial='s3\t1')
+    assert resume_output(str(out_path), HEADER, str(calls_path), CALLS_HEADER) == {'s1', 's2'}
+    assert out_path.read_text() == f'{HEADER}\ns1\tA\ns2\tB\n'
+    assert calls_path.read_text().splitlines(keepends=True)[2:] == [calls_line('s1'), calls_line('s2')]
+
+
+def test_different_output_format_is_rejected(tmp_path):
+    out_path = tmp_path / 'out.tsv'
+    out_path.write_text('Sample Name\tOther\ns1\tA\n')
+    with pytest.raises(ResumeError):
+        resume_output(str(out_path), HEADER, None, CALLS_HEADER)
+    assert out_path.read_text() == 'Sample Name\tOther\ns1\tA\n'
+
+
+def test_calls_of_other_models_are_rejected(tmp_path):
+    out_path, calls_path = tmp_path / 'out.tsv', tmp_path / 'out.calls'
+    out_path.write_text(f'{HEADER}\ns1\tA\n')
+    write_calls(calls_path, ['s1'])
+    with pytest.raises(ResumeError):
+        resume_output(str(out_path), HEADER, str(calls_path), CallsHeader('2026-01-02', '2025-01-01'))
+
+
+def test_mismatched_samples_are_rejected(tmp_path):
+    out_path, calls_path = tmp_path / 'out.tsv', tmp_path / 'out.calls'
+    out_path.write_text(f'{HEADER}\ns1\tA\n')
+    write_calls(calls_path, ['s2'])
+    with pytest.raises(ResumeError):
+        resume_output(str(out_path), HEADER, str(calls_path), CALLS_HEADER)
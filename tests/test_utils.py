@@ -0,0 +1,55 @@
+'''
+Tests of the helpers in `genin2.utils`.
+'''
+import threading
+import pytest
+from genin2.utils import chunked_available, in_shard
+
+
+def test_chunked_available_yields_ready_items_without_waiting():
+    # The first items are available at once, the last one only after the first chunk has been consumed
+    first_consumed = threading.Event()
+
+    def items():
+        yield 1
+        yield 2
+        if not first_consumed.wait(5):
+            raise TimeoutError("The first chunk was not yielded until more items were ready")
+        yield 3
+
+    chunks = chunked_available(items(), 10)
+    first = next(chunks)
+    first_consumed.set()
+    assert 3 not in first
+    assert [item for chunk in [first, *chunks] for item in chunk] == [1, 2, 3]
+
+
+def test_chunked_available_limits_chunk_size():
+    chunks = list(chunked_available(range(25), 10))
+    assert all(len(chunk) <= 10 for chunk in chunks)
+    assert [item for chunk in chunks for item in chunk] == list(range(25))
+
+
+def test_chunked_available_reraises_errors():
+    def items():
+        yield 1
+        raise ValueError('bad input')
+
+    with pytest.raises(ValueError, match='bad input'):
+        list(chunked_available(items(), 10))
+
+
+@pytest.mark.parametrize('count', [1, 2, 3, 7])
+def test_shards_partition_samples(count):
+    names = [f'sample{i}' for i in range(500)]
+    shards = [{name for name in names if in_shard(name, index, count)} for index in range(1, count + 1)]
+    assert sum(len(shard) for shard in shards) == len(names)
+    assert set().union(*shards) == set(names)
+    if count > 1:
+        assert all(shard for shard in shards)
+
+
+def test_shards_are_stable():
+    # The shards must not depend on the process (e.g. on the hash seed), so that shards of a file computed by
+    # different runs are disjoint
+    assert [in_shard('A/duck/Italy/1234/2024', index, 4) for index in range(1, 5)] == [False, False, False, True]